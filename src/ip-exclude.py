@@ -1,9 +1,21 @@
 #!/usr/bin/env python3
+import heapq
 import ipaddress
+import resource
+import struct
+import sys
+import tempfile
 import textwrap
-from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+import time
+from argparse import (
+    ArgumentDefaultsHelpFormatter, ArgumentParser, ArgumentTypeError)
+from iptrie import read_fd
 
-# Getting IPv4 address ranges of OVH: visit these pages.
+# Getting IPv4 address ranges of OVH: download a RIB dump, for example from
+#    https://archive.routeviews.org/bgpdata/
+# and extract the prefixes originated by OVH's ASes from it.
+#    ./mrt-prefixes.py -a AS16276 -a AS35540 -f 4 rib.*.bz2 > ovh-nets.txt
+# Or visit these pages.
 #    https://bgp.he.net/AS16276#_prefixes
 #    https://bgp.he.net/AS35540#_prefixes
 # Manually copy paste the tables into a text file. Hope you're efficent at vim
@@ -17,6 +29,9 @@ from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 # <c grep -vF '[' | cut -d ':' -f 1 > ovh-relays.txt
 # rm a b c
 
+# # Checking which OVH relays are in the output of this script
+# ./iptrie.py -i ovh-nets.txt -e exclude.txt ovh-relays.txt
+
 
 def _wrap_line(tw, s):
     ''' Given a :class:`textwrap.TextWrapper` and a single long line of text
@@ -75,66 +90,254 @@ def print_list_as_comment(l):
         print(f'#    {line}', end='')
 
 
-def read_fd(fd):
-    ''' Create a set with all the IPv4 networks listed in the given file-like
-    object. Ignore empty lines and comment lines (starting with '#'). '''
-    s = set()
+def net_sort_key(net):
+    ''' Sort key for networks of possibly mixed IP versions. Networks of
+    different versions cannot be compared directly, so sort all IPv4 networks
+    before all IPv6 ones. '''
+    return (net.version, net)
+
+
+def nets_to_ranges(nets):
+    ''' Turn the given networks into a sorted list of integer ``(version,
+    first, last)`` tuples, one per network. Both ends are inclusive. '''
+    return sorted(
+        (net.version, int(net.network_address), int(net.broadcast_address))
+        for net in nets)
+
+
+def coalesce_ranges(ranges):
+    ''' Given an iterable of ``(version, first, last)`` tuples sorted by
+    version and then first address, yield the same address space as the
+    smallest number of disjoint, non-adjacent ranges, still in sorted order.
+    '''
+    cur = None
+    for ver, first, last in ranges:
+        if cur is not None and ver == cur[0] and first <= cur[2] + 1:
+            if last > cur[2]:
+                cur[2] = last
+            continue
+        if cur is not None:
+            yield tuple(cur)
+        cur = [ver, first, last]
+    if cur is not None:
+        yield tuple(cur)
+
+
+def subtract_ranges(include, exclude):
+    ''' Given two iterables of sorted, disjoint ``(version, first, last)``
+    tuples (such as the output of :func:`coalesce_ranges`), yield the address
+    space that is in ``include`` but not in ``exclude``. This is a single
+    linear sweep over both inputs. '''
+    exclude = iter(exclude)
+    ex = next(exclude, None)
+    for ver, first, last in include:
+        # skip exclude ranges entirely before this include range
+        while ex is not None and (ex[0], ex[2]) < (ver, first):
+            ex = next(exclude, None)
+        # carve away each exclude range that overlaps this include range
+        while ex is not None and ex[0] == ver and ex[1] <= last:
+            if ex[1] > first:
+                yield (ver, first, ex[1] - 1)
+            if ex[2] >= last:
+                break
+            first = ex[2] + 1
+            ex = next(exclude, None)
+        else:
+            yield (ver, first, last)
+
+
+def ranges_to_nets(ranges):
+    ''' Yield the smallest list of CIDR networks that exactly covers each of
+    the given ``(version, first, last)`` ranges. '''
+    for ver, first, last in ranges:
+        addr = ipaddress.IPv4Address if ver == 4 else ipaddress.IPv6Address
+        yield from ipaddress.summarize_address_range(addr(first), addr(last))
+
+
+def subtract_nets(include_nets, exclude_nets):
+    ''' Return a list of networks covering all the address space in
+    ``include_nets`` that is not in ``exclude_nets``, sorted by IP version and
+    then address. '''
+    return list(ranges_to_nets(subtract_ranges(
+        coalesce_ranges(nets_to_ranges(include_nets)),
+        coalesce_ranges(nets_to_ranges(exclude_nets)))))
+
+
+def verify(output_nets, include_nets, exclude_nets):
+    ''' Slow O(n*m) sanity check that no output net overlaps an exclude net
+    and that every output net is within some include net. '''
+    for out_net in output_nets:
+        for ex_net in exclude_nets:
+            assert not out_net.overlaps(ex_net), (out_net, ex_net)
+        assert any(
+            out_net.version == in_net.version and out_net.subnet_of(in_net)
+            for in_net in include_nets), out_net
+
+
+# On-disk record used by --stream mode: IP version, first address, last
+# address. Addresses are big endian and fixed width, so sorting the packed
+# bytes sorts the records by (version, first, last).
+RECORD = struct.Struct('>B16s16s')
+# Smallest --run-size. Every run is a temporary file, and they are all open at
+# once while merging, so tiny runs would run out of file descriptors.
+MIN_RUN_SIZE = 10000
+# Most records to read from a run file at once while merging
+MAX_BLOCK_RECORDS = 4096
+
+
+def spill_sorted_runs(fd, run_size, tmp_dir=None):
+    ''' Read networks from the given file-like object (same format as
+    :func:`read_fd`) and spill them to temporary files as packed
+    :data:`RECORD` structs, each file a sorted run of at most ``run_size``
+    records. Returns the list of run files, each rewound to the start, and the
+    number of networks read. '''
+    runs = []
+    count = 0
+    buf = []
+
+    def spill():
+        f = tempfile.TemporaryFile(dir=tmp_dir)
+        buf.sort()
+        f.write(b''.join(buf))
+        f.seek(0)
+        runs.append(f)
+        buf.clear()
+
     for line in fd:
         line = line.strip()
         if not len(line) or line.startswith('#'):
             continue
-        s.add(ipaddress.ip_network(line))
-    return s
+        net = ipaddress.ip_network(line)
+        buf.append(RECORD.pack(
+            net.version,
+            int(net.network_address).to_bytes(16, 'big'),
+            int(net.broadcast_address).to_bytes(16, 'big')))
+        count += 1
+        if len(buf) >= run_size:
+            spill()
+    if buf:
+        spill()
+    return runs, count
+
+
+def read_run(f, block_records=MAX_BLOCK_RECORDS):
+    ''' Yield the ``(version, first, last)`` tuples stored in a run file
+    written by :func:`spill_sorted_runs`, reading it in large blocks. '''
+    while True:
+        block = f.read(RECORD.size * block_records)
+        if not block:
+            return
+        for ver, first, last in RECORD.iter_unpack(block):
+            yield (
+                ver, int.from_bytes(first, 'big'), int.from_bytes(last, 'big'))
+
+
+def merge_runs(runs, run_size):
+    ''' k-way merge the given sorted run files into one sorted stream of
+    ``(version, first, last)`` tuples, reading each in blocks small enough
+    that all of them together hold at most ``run_size`` records. '''
+    block_records = max(1, min(MAX_BLOCK_RECORDS, run_size // len(runs))) \
+        if runs else 1
+    return heapq.merge(*[read_run(f, block_records) for f in runs])
+
+
+def main_stream(include_fd, exclude_fd, run_size, tmp_dir=None):
+    ''' Like :func:`main`, but holds at most ``run_size`` networks in memory
+    at once: while reading, the run being sorted, and while merging, a block
+    of each run of the include list and of the exclude list. The input lists
+    are not echoed back as comments, and output networks are written as soon
+    as they are known. '''
+    start = time.time()
+    inc_runs, num_inc = spill_sorted_runs(include_fd, run_size, tmp_dir)
+    exc_runs, num_exc = spill_sorted_runs(exclude_fd, run_size, tmp_dir)
+    num_out = 0
+    for out_net in ranges_to_nets(subtract_ranges(
+            coalesce_ranges(merge_runs(inc_runs, run_size // 2)),
+            coalesce_ranges(merge_runs(exc_runs, run_size // 2)))):
+        print(out_net)
+        num_out += 1
+    for f in inc_runs + exc_runs:
+        f.close()
+    duration = time.time() - start
+    # ru_maxrss is KiB on Linux, but bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        max_rss //= 1024
+    print(f'# {num_inc} input include nets, {num_exc} input exclude nets '
+          f'({len(inc_runs)} + {len(exc_runs)} sorted runs)')
+    print(f'# {num_out} output nets')
+    print(f'# {duration:.2f} seconds, '
+          f'{(num_inc + num_exc) / max(duration, 1e-9):.0f} input nets/sec, '
+          f'peak RSS {max_rss / 1024:.1f} MiB')
+
+
+def run_size_type(s):
+    n = int(s)
+    if n < MIN_RUN_SIZE:
+        raise ArgumentTypeError('must be at least %d' % (MIN_RUN_SIZE,))
+    return n
 
 
-def main(include_fd, exclude_fd):
-    include_nets, exclude_nets = set(), set()
-    output_nets = set()
+def main(include_fd, exclude_fd, do_verify=False):
     include_nets = read_fd(include_fd)
     exclude_nets = read_fd(exclude_fd)
     print(f'# {len(include_nets)} input include nets:')
-    print_list_as_comment(sorted(include_nets))
+    print_list_as_comment(sorted(include_nets, key=net_sort_key))
     print(f'# {len(exclude_nets)} input exclude nets:')
-    print_list_as_comment(sorted(exclude_nets))
-    output_nets = set()
-    while len(include_nets):
-        in_net = include_nets.pop()
-        for ex_net in exclude_nets:
-            if in_net.overlaps(ex_net):
-                new = in_net.address_exclude(ex_net)
-                include_nets.update(new)
-                break
-        else:
-            output_nets.add(in_net)
+    print_list_as_comment(sorted(exclude_nets, key=net_sort_key))
+    output_nets = subtract_nets(include_nets, exclude_nets)
     print(f'# {len(output_nets)} output nets')
-    for out_net in sorted(output_nets):
-        print(out_net)
-    # sanity check. Due to the way the overlaps() function works, I worry that
-    # certain types of input could result in these checks failing
     for out_net in output_nets:
-        for ex_net in exclude_nets:
-            assert not out_net.overlaps(ex_net)
+        print(out_net)
+    if do_verify:
+        verify(output_nets, include_nets, exclude_nets)
 
 
 if __name__ == '__main__':
     parser = ArgumentParser(
         formatter_class=ArgumentDefaultsHelpFormatter,
-        description='Takes a list of IPv4 subnets to include. Takes a '
-        'list of IPv4 subnets to exclude. Output the inlcude-list of '
-        'subnets, modified such that they do not include any IP space '
-        'in the exclude list.')
+        description='Takes a list of IPv4/IPv6 subnets to include. Takes a '
+        'list of IPv4/IPv6 subnets to exclude. Output the smallest list of '
+        'subnets covering the include-list, modified such that they do not '
+        'include any IP space in the exclude list.')
     parser.add_argument(
         'include_file', type=str,
-        help='File from which to read IPv4 subnets to include, one per '
-        'line. Format: 1.2.3.4/5')
+        help='File from which to read subnets to include, one per '
+        'line. Format: 1.2.3.4/5 or 2001:db8::/32')
     parser.add_argument(
         'exclude_file', type=str,
-        help='File from which to read IPv4 subnets to exclude, one per '
-        'line. Format: 1.2.3.4/5')
+        help='File from which to read subnets to exclude, one per '
+        'line. Format: 1.2.3.4/5 or 2001:db8::/32')
+    parser.add_argument(
+        '--verify', action='store_true',
+        help='After computing the output, do a slow O(n*m) check that no '
+        'output subnet overlaps an excluded subnet')
+    parser.add_argument(
+        '--stream', action='store_true',
+        help='Use bounded memory: spill the inputs to sorted temporary files '
+        'and merge them instead of loading them all at once. Incompatible '
+        'with --verify')
+    parser.add_argument(
+        '--run-size', type=run_size_type, default=500000,
+        help='With --stream, the maximum number of subnets to hold in memory '
+        'and write to each temporary file. At least %d' % (MIN_RUN_SIZE,))
+    parser.add_argument(
+        '--tmp-dir', type=str,
+        help='With --stream, where to put temporary files. Defaults to the '
+        'system temporary directory')
     args = parser.parse_args()
+    if args.stream and args.verify:
+        parser.error('--stream and --verify cannot be used together')
     try:
-        main(
-            open(args.include_file, 'rt'),
-            open(args.exclude_file, 'rt'))
+        if args.stream:
+            main_stream(
+                open(args.include_file, 'rt'),
+                open(args.exclude_file, 'rt'),
+                args.run_size, tmp_dir=args.tmp_dir)
+        else:
+            main(
+                open(args.include_file, 'rt'),
+                open(args.exclude_file, 'rt'),
+                do_verify=args.verify)
     except KeyboardInterrupt:
         print()
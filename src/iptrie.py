@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+''' Longest-prefix-match index over the include/exclude subnet lists used by
+ip-exclude.py. Classifies large lists of IP addresses (for example, the
+addresses of relays in some AS) without creating an :mod:`ipaddress` object
+per lookup.
+
+Example::
+
+    ./iptrie.py -i ovh-nets.txt -e exclude.txt --save ovh.idx < ovh-relays.txt
+    ./iptrie.py --load ovh.idx --survivors < ovh-relays.txt
+
+Or from python::
+
+    idx = IPIndex.from_nets(read_fd(open('in.txt')), read_fd(open('ex.txt')))
+    for addr, (prefix, survives) in zip(addrs, idx.classify(addrs)):
+        ...
+'''
+import ipaddress
+import itertools
+import socket
+import sys
+from bisect import bisect_right
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, FileType
+from array import array
+
+# Flags stored on trie nodes saying which input list(s) a prefix came from
+INCLUDE = 1
+EXCLUDE = 2
+
+MAGIC = b'IPTRIE1\n'
+
+
+def read_fd(fd):
+    ''' Create a set with all the IPv4 and IPv6 networks listed in the given
+    file-like object. Ignore empty lines and comment lines (starting with '#').
+    Also used by ip-exclude.py. '''
+    s = set()
+    for line in fd:
+        line = line.strip()
+        if not len(line) or line.startswith('#'):
+            continue
+        s.add(ipaddress.ip_network(line))
+    return s
+
+
+class PrefixTrie:
+    ''' A path-compressed binary (Patricia) trie over the prefixes of one IP
+    version.
+
+    Nodes live in parallel flat arrays instead of one Python object each, which
+    keeps the trie small, fast to walk, and trivial to write to disk. For node
+    ``i``, ``keys[i]`` is the prefix's top ``bits - shifts[i]`` bits (i.e. the
+    network address shifted right by ``shifts[i]``), ``flags[i]`` is a bitmask
+    of :data:`INCLUDE` and :data:`EXCLUDE` (0 for internal nodes that only
+    exist to branch), and ``lefts[i]``/``rights[i]`` are child indexes or -1.
+    Node 0, if it exists, is the root.
+
+    The trie is used to build the index. Lookups use a flattened table of
+    address intervals derived from it (see :meth:`flatten`), which turns each
+    lookup into a single binary search. '''
+    def __init__(self, version):
+        assert version in (4, 6)
+        self.version = version
+        self.bits = 32 if version == 4 else 128
+        self.keys = []
+        self.shifts = array('B')
+        self.flags = array('B')
+        self.lefts = array('i')
+        self.rights = array('i')
+        self._labels = {}
+        # lookup table computed by flatten()
+        self.starts, self.matches, self.survives = None, None, None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _invalidate(self):
+        ''' Forget the lookup table and labels, which are stale once the trie
+        changes. '''
+        self.starts = None
+        self._labels.clear()
+
+    def _new_node(self, key, plen, flag):
+        self._invalidate()
+        self.keys.append(key)
+        self.shifts.append(self.bits - plen)
+        self.flags.append(flag)
+        self.lefts.append(-1)
+        self.rights.append(-1)
+        return len(self.keys) - 1
+
+    def _bit_after(self, key, plen, at):
+        ''' Return the bit just after the first ``at`` bits of the prefix
+        ``key``/``plen``. Requires ``at < plen``. '''
+        return (key >> (plen - at - 1)) & 1
+
+    def _set_child(self, parent, bit, child):
+        if bit:
+            self.rights[parent] = child
+        else:
+            self.lefts[parent] = child
+
+    def _replace(self, parent, bit, old, new):
+        ''' Put ``new`` where ``old`` is, which is either the root or the
+        ``bit`` child of ``parent``. If it's the root, the caller must swap its
+        idea of which index is ``old`` and which is ``new`` afterwards. '''
+        if parent < 0:
+            # The root must stay at index 0, so swap the two nodes' contents.
+            # Nothing points at either of them yet, so no links need fixing.
+            assert old == 0
+            self._invalidate()
+            for a in (self.keys, self.shifts, self.flags, self.lefts,
+                      self.rights):
+                a[old], a[new] = a[new], a[old]
+        else:
+            self._set_child(parent, bit, new)
+
+    def insert(self, net, flag):
+        ''' Add the given network, which must be of this trie's IP version, and
+        mark it with ``flag``. '''
+        assert net.version == self.version
+        plen = net.prefixlen
+        key = int(net.network_address) >> (self.bits - plen)
+        if not len(self):
+            self._new_node(key, plen, flag)
+            return
+        node, parent, bit = 0, -1, 0
+        while True:
+            node_plen = self.bits - self.shifts[node]
+            node_key = self.keys[node]
+            # length of the common prefix of the two prefixes
+            shortest = min(plen, node_plen)
+            diff = (key >> (plen - shortest)) ^ \
+                (node_key >> (node_plen - shortest))
+            common = shortest - diff.bit_length()
+            if common == node_plen == plen:
+                # same prefix
+                self.flags[node] |= flag
+                self._invalidate()
+                return
+            if common == node_plen:
+                # the node is a prefix of us, so keep going down
+                parent, bit = node, self._bit_after(key, plen, node_plen)
+                child = self.rights[node] if bit else self.lefts[node]
+                if child < 0:
+                    self._set_child(node, bit, self._new_node(key, plen, flag))
+                    return
+                node = child
+                continue
+            if common == plen:
+                # we are a prefix of the node, so go between it and its parent
+                new = self._new_node(key, plen, flag)
+                self._replace(parent, bit, node, new)
+                if parent < 0:
+                    node, new = new, node
+                self._set_child(
+                    new, self._bit_after(node_key, node_plen, plen), node)
+                return
+            # we diverge from the node partway through it, so add a branching
+            # node for our common prefix with us and the node as its children
+            glue = self._new_node(key >> (plen - common), common, 0)
+            self._replace(parent, bit, node, glue)
+            if parent < 0:
+                node, glue = glue, node
+            self._set_child(
+                glue, self._bit_after(node_key, node_plen, common), node)
+            self._set_child(
+                glue, self._bit_after(key, plen, common),
+                self._new_node(key, plen, flag))
+            return
+
+    def walk(self, addr):
+        ''' Given an integer address, return the index of the node with the
+        longest matching prefix (or -1 if none match) and whether the address
+        is in some included prefix and not in any excluded prefix, by walking
+        down the trie. :meth:`lookup` gives the same answer faster. '''
+        keys, shifts, flags = self.keys, self.shifts, self.flags
+        lefts, rights = self.lefts, self.rights
+        node = 0 if len(keys) else -1
+        best, seen = -1, 0
+        while node >= 0:
+            shift = shifts[node]
+            if addr >> shift != keys[node]:
+                break
+            f = flags[node]
+            if f:
+                best = node
+                seen |= f
+            if not shift:
+                break
+            node = rights[node] if (addr >> (shift - 1)) & 1 else lefts[node]
+        return best, seen == INCLUDE
+
+    def flatten(self):
+        ''' Precompute the answer :meth:`walk` would give for every address by
+        splitting the address space into the sorted, disjoint intervals in
+        which the answer doesn't change. ``starts[i]`` is the first address of
+        interval ``i``, ``matches[i]`` its longest matching node, and
+        ``survives[i]`` 1 if its addresses survive the exclusion, else 0. '''
+        starts = array('L') if self.version == 4 else []
+        matches, survives = array('i'), array('B')
+
+        def emit(start, best, seen):
+            if len(starts) and starts[-1] == start:
+                matches[-1], survives[-1] = best, seen == INCLUDE
+            else:
+                starts.append(start)
+                matches.append(best)
+                survives.append(seen == INCLUDE)
+
+        def visit(node, best, seen):
+            shift = self.shifts[node]
+            start = self.keys[node] << shift
+            end = start + (1 << shift) - 1
+            if self.flags[node]:
+                best, seen = node, seen | self.flags[node]
+            emit(start, best, seen)
+            for child in (self.lefts[node], self.rights[node]):
+                if child < 0:
+                    continue
+                child_end = visit(child, best, seen)
+                if child_end < end:
+                    emit(child_end + 1, best, seen)
+            return end
+
+        emit(0, -1, 0)
+        if len(self):
+            end = visit(0, -1, 0)
+            if end < (1 << self.bits) - 1:
+                emit(end + 1, -1, 0)
+        self.starts, self.matches, self.survives = starts, matches, survives
+
+    def lookup(self, addr):
+        ''' Same as :meth:`walk`, but with one binary search over the
+        intervals computed by :meth:`flatten`. '''
+        if self.starts is None:
+            self.flatten()
+        i = bisect_right(self.starts, addr) - 1
+        return self.matches[i], bool(self.survives[i])
+
+    def label(self, node):
+        ''' Return the string form of the prefix at the given node, e.g.
+        '10.0.0.0/8'. Cached, since the same few prefixes match over and over.
+        '''
+        try:
+            return self._labels[node]
+        except KeyError:
+            shift = self.shifts[node]
+            cls = ipaddress.IPv4Network if self.version == 4 \
+                else ipaddress.IPv6Network
+            s = str(cls((self.keys[node] << shift, self.bits - shift)))
+            self._labels[node] = s
+            return s
+
+    def write(self, fd):
+        ''' Write the trie and its lookup table to the given binary file-like
+        object. Integers are big endian, arrays little endian. '''
+        if self.starts is None:
+            self.flatten()
+        width = self.bits // 8
+        fd.write(bytes([self.version]))
+        for ints, arrays in (
+                (self.keys, (self.shifts, self.flags, self.lefts,
+                             self.rights)),
+                (self.starts, (self.matches, self.survives))):
+            fd.write(len(ints).to_bytes(4, 'big'))
+            fd.write(b''.join(i.to_bytes(width, 'big') for i in ints))
+            for a in arrays:
+                if sys.byteorder != 'little':
+                    a = array(a.typecode, a)
+                    a.byteswap()
+                fd.write(a.tobytes())
+
+    @staticmethod
+    def read(fd):
+        ''' Read a trie written with :meth:`write`. '''
+        t = PrefixTrie(fd.read(1)[0])
+        width = t.bits // 8
+        t.starts = array('L') if t.version == 4 else []
+        t.matches, t.survives = array('i'), array('B')
+        for ints, arrays in (
+                (t.keys, (t.shifts, t.flags, t.lefts, t.rights)),
+                (t.starts, (t.matches, t.survives))):
+            num = int.from_bytes(fd.read(4), 'big')
+            blob = fd.read(num * width)
+            ints.extend(
+                int.from_bytes(blob[i:i + width], 'big')
+                for i in range(0, len(blob), width))
+            for a in arrays:
+                a.frombytes(fd.read(num * a.itemsize))
+                if sys.byteorder != 'little':
+                    a.byteswap()
+        return t
+
+
+class IPIndex:
+    ''' Classifies addresses against a set of included and a set of excluded
+    networks, which may be IPv4, IPv6, or both. '''
+    def __init__(self, trie4=None, trie6=None):
+        self.trie4 = trie4 or PrefixTrie(4)
+        self.trie6 = trie6 or PrefixTrie(6)
+
+    @staticmethod
+    def from_nets(include_nets, exclude_nets):
+        idx = IPIndex()
+        for nets, flag in ((include_nets, INCLUDE), (exclude_nets, EXCLUDE)):
+            for net in nets:
+                t = idx.trie4 if net.version == 4 else idx.trie6
+                t.insert(net, flag)
+        return idx
+
+    def classify(self, addresses):
+        ''' Given an iterable of IPv4/IPv6 addresses as strings, yield a
+        ``(prefix, survives)`` tuple for each. ``prefix`` is the longest
+        matching include or exclude prefix as a string, or None if none match.
+        ``survives`` is True if the address is in some included network and in
+        no excluded network.
+
+        Raises :class:`ValueError` on an address that can't be parsed. '''
+        # This is the hot loop, so look up everything it needs only once.
+        tables = []
+        for t in (self.trie4, self.trie6):
+            if t.starts is None:
+                t.flatten()
+            tables.append((t.starts, t.matches, t.survives, t.label))
+        table4, table6 = tables
+        inet_pton, AF_INET, AF_INET6 = \
+            socket.inet_pton, socket.AF_INET, socket.AF_INET6
+        from_bytes = int.from_bytes
+        for a in addresses:
+            try:
+                if ':' in a:
+                    starts, matches, survives, label = table6
+                    addr = from_bytes(inet_pton(AF_INET6, a), 'big')
+                else:
+                    starts, matches, survives, label = table4
+                    addr = from_bytes(inet_pton(AF_INET, a), 'big')
+            except OSError:
+                raise ValueError('Invalid IP address: %r' % (a,)) from None
+            i = bisect_right(starts, addr) - 1
+            node = matches[i]
+            yield (label(node) if node >= 0 else None), survives[i] == 1
+
+    def save(self, fname):
+        with open(fname, 'wb') as fd:
+            fd.write(MAGIC)
+            self.trie4.write(fd)
+            self.trie6.write(fd)
+
+    @staticmethod
+    def load(fname):
+        with open(fname, 'rb') as fd:
+            if fd.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not an IPIndex file' % (fname,))
+            return IPIndex(PrefixTrie.read(fd), PrefixTrie.read(fd))
+
+
+def main(args):
+    if args.load:
+        idx = IPIndex.load(args.load)
+    else:
+        with open(args.include, 'rt') as in_fd, \
+                open(args.exclude, 'rt') as ex_fd:
+            idx = IPIndex.from_nets(read_fd(in_fd), read_fd(ex_fd))
+    if args.save:
+        idx.save(args.save)
+    with args.addresses as fd:
+        addrs = (line.strip() for line in fd)
+        addrs = (a for a in addrs if a and not a.startswith('#'))
+        # one copy of the address stream for classify() and one for printing
+        addrs, to_classify = itertools.tee(addrs)
+        out = sys.stdout
+        for a, (prefix, survives) in zip(addrs, idx.classify(to_classify)):
+            if args.survivors:
+                if survives:
+                    out.write(a + '\n')
+            else:
+                out.write('%s %s %s\n' % (
+                    a, prefix or '-', 'yes' if survives else 'no'))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        description='Classify IPv4/IPv6 addresses against a list of subnets '
+        'to include and a list of subnets to exclude (same files as '
+        'ip-exclude.py takes). For each address, output the address, the '
+        'longest matching subnet (or "-"), and "yes" if the address is in '
+        'an included subnet and not in an excluded one, else "no".')
+    parser.add_argument(
+        '-i', '--include', type=str,
+        help='File from which to read subnets to include, one per line')
+    parser.add_argument(
+        '-e', '--exclude', type=str,
+        help='File from which to read subnets to exclude, one per line')
+    parser.add_argument(
+        '--load', type=str, metavar='IDX',
+        help='Load a previously --save\'ed index instead of building one '
+        'from --include and --exclude')
+    parser.add_argument(
+        '--save', type=str, metavar='IDX',
+        help='Save the index to this file for use with --load later')
+    parser.add_argument(
+        '--survivors', action='store_true',
+        help='Only output the addresses that survive the exclusion, one per '
+        'line, instead of the full classification')
+    parser.add_argument(
+        'addresses', nargs='?', type=FileType('rt'), default=sys.stdin,
+        help='File from which to read addresses, one per line. Defaults to '
+        'stdin')
+    args = parser.parse_args()
+    if not args.load and not (args.include and args.exclude):
+        parser.error('Either --load or both --include and --exclude required')
+    try:
+        main(args)
+    except KeyboardInterrupt:
+        print()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+''' Extract all the prefixes originated by some set of ASNs from a locally
+stored MRT TABLE_DUMP_V2 RIB dump (RFC 6396, and the RFC 8050 ADD-PATH
+variants), such as the rib.*.bz2 files published by RouteViews and RIPE RIS.
+The output is one prefix per line, ready to give to ip-exclude.py.
+
+    ./mrt-prefixes.py -a AS16276 -a AS35540 rib.20260101.0000 > ovh-nets.txt
+
+The dump is parsed one record at a time, so memory use doesn't depend on the
+size of the table. Uncompressed dumps can be split across several worker
+processes with -j. '''
+import bz2
+import gzip
+import os
+import socket
+import struct
+import sys
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from multiprocessing import Pool
+
+# MRT common header: timestamp, type, subtype, length of the body
+MRT_HEADER = struct.Struct('>IHHI')
+TABLE_DUMP_V2 = 13
+# TABLE_DUMP_V2 subtypes that hold RIB entries, mapped to the IP version of
+# their prefixes and whether their entries have an ADD-PATH path identifier.
+RIB_SUBTYPES = {
+    2: (4, False),  # RIB_IPV4_UNICAST
+    3: (4, False),  # RIB_IPV4_MULTICAST
+    4: (6, False),  # RIB_IPV6_UNICAST
+    5: (6, False),  # RIB_IPV6_MULTICAST
+    8: (4, True),  # RIB_IPV4_UNICAST_ADDPATH
+    9: (4, True),  # RIB_IPV4_MULTICAST_ADDPATH
+    10: (6, True),  # RIB_IPV6_UNICAST_ADDPATH
+    11: (6, True),  # RIB_IPV6_MULTICAST_ADDPATH
+}
+# BGP path attribute type and AS_PATH segment types we care about
+ATTR_AS_PATH = 2
+AS_SET = 1
+AS_SEQUENCE = 2
+# BGP path attribute flag meaning the length field is two bytes
+ATTR_FLAG_EXTENDED_LENGTH = 0x10
+BUF_SIZE = 1024 * 1024
+
+
+def open_dump(fname):
+    ''' Open the given MRT dump for reading, transparently decompressing it
+    if its name ends in .gz or .bz2. '''
+    if fname.endswith('.gz'):
+        return gzip.open(fname, 'rb')
+    if fname.endswith('.bz2'):
+        return bz2.open(fname, 'rb')
+    return open(fname, 'rb', buffering=BUF_SIZE)
+
+
+def iter_records(fd, end=None):
+    ''' Yield ``(type, subtype, body)`` for each MRT record in the given binary
+    file-like object, starting at its current position and stopping at EOF or
+    when the byte offset ``end`` is reached. ``body`` is a bytes object. '''
+    pos = fd.tell() if end is not None else 0
+    while end is None or pos < end:
+        header = fd.read(MRT_HEADER.size)
+        if len(header) < MRT_HEADER.size:
+            return
+        _, typ, subtype, length = MRT_HEADER.unpack(header)
+        body = fd.read(length)
+        if len(body) < length:
+            print('WARN: truncated MRT record at end of file', file=sys.stderr)
+            return
+        pos += MRT_HEADER.size + length
+        yield typ, subtype, body
+
+
+def origin_asns(attrs):
+    ''' Given the BGP path attributes of a RIB entry, return a tuple of the
+    ASN(s) that originated the route: the last ASN in the AS_PATH, or every
+    ASN in it if the path ends in an AS_SET. AS numbers in TABLE_DUMP_V2 are
+    always 4 bytes. '''
+    i, n = 0, len(attrs)
+    while i + 3 <= n:
+        flags, typ = attrs[i], attrs[i + 1]
+        if flags & ATTR_FLAG_EXTENDED_LENGTH:
+            length = (attrs[i + 2] << 8) | attrs[i + 3]
+            i += 4
+        else:
+            length = attrs[i + 2]
+            i += 3
+        if typ != ATTR_AS_PATH:
+            i += length
+            continue
+        path, j, last = attrs[i:i + length], 0, ()
+        while j + 2 <= len(path):
+            seg_type, seg_len = path[j], path[j + 1]
+            seg = path[j + 2:j + 2 + 4 * seg_len]
+            j += 2 + 4 * seg_len
+            if seg_type == AS_SEQUENCE and seg_len:
+                last = (int.from_bytes(seg[-4:], 'big'),)
+            elif seg_type == AS_SET and seg_len:
+                last = struct.unpack('>%dI' % (seg_len,), seg)
+        return last
+    return ()
+
+
+def parse_rib(body, version, addpath, asns):
+    ''' Given the body of a TABLE_DUMP_V2 RIB record, return its prefix as a
+    string if any of its entries was originated by one of ``asns``, else
+    None. '''
+    plen = body[4]
+    nbytes = (plen + 7) // 8
+    i = 5 + nbytes
+    num_entries = (body[i] << 8) | body[i + 1]
+    i += 2
+    found = False
+    for _ in range(num_entries):
+        # peer index (2), originated time (4), and maybe path identifier (4)
+        i += 10 if addpath else 6
+        attr_len = (body[i] << 8) | body[i + 1]
+        i += 2
+        if not asns.isdisjoint(origin_asns(body[i:i + attr_len])):
+            found = True
+            break
+        i += attr_len
+    if not found:
+        return None
+    width, family = (4, socket.AF_INET) if version == 4 \
+        else (16, socket.AF_INET6)
+    addr = bytes(body[5:5 + nbytes]).ljust(width, b'\0')
+    return '%s/%d' % (socket.inet_ntop(family, addr), plen)
+
+
+def extract(fd, asns, versions, end=None):
+    ''' Yield each prefix in the MRT dump read from ``fd`` (starting at its
+    current position and stopping at ``end``, if given) that is of an IP
+    version in ``versions`` and was originated by one of ``asns``. '''
+    for typ, subtype, body in iter_records(fd, end=end):
+        if typ != TABLE_DUMP_V2 or subtype not in RIB_SUBTYPES:
+            continue
+        version, addpath = RIB_SUBTYPES[subtype]
+        if version not in versions:
+            continue
+        prefix = parse_rib(memoryview(body), version, addpath, asns)
+        if prefix is not None:
+            yield prefix
+
+
+def split_offsets(fname, num_chunks):
+    ''' Return a list of ``(start, end)`` byte ranges that split the given
+    uncompressed MRT dump into roughly ``num_chunks`` equally sized pieces,
+    each starting and ending on a record boundary. Only record headers are
+    read; bodies are seeked over. '''
+    size = os.path.getsize(fname)
+    target = max(1, size // num_chunks)
+    offsets = [0]
+    with open(fname, 'rb', buffering=BUF_SIZE) as fd:
+        pos = 0
+        while True:
+            header = fd.read(MRT_HEADER.size)
+            if len(header) < MRT_HEADER.size:
+                break
+            pos += MRT_HEADER.size + MRT_HEADER.unpack(header)[3]
+            fd.seek(pos)
+            if pos - offsets[-1] >= target:
+                offsets.append(pos)
+    if offsets[-1] < size:
+        offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def extract_chunk(job):
+    ''' Worker process entry point: extract the matching prefixes from one
+    byte range of an uncompressed MRT dump. '''
+    fname, start, end, asns, versions = job
+    with open(fname, 'rb', buffering=BUF_SIZE) as fd:
+        fd.seek(start)
+        return list(extract(fd, asns, versions, end=end))
+
+
+def parse_asn(s):
+    ''' Turn 'AS16276', 'as16276', or '16276' into 16276 '''
+    if s[:2].lower() == 'as':
+        s = s[2:]
+    return int(s)
+
+
+def main(args):
+    asns = frozenset(args.asn)
+    versions = {4, 6} if not args.family else {args.family}
+    seen = set()
+    for fname in args.dump:
+        compressed = fname.endswith(('.gz', '.bz2'))
+        if args.jobs > 1 and not compressed:
+            jobs = [
+                (fname, start, end, asns, versions)
+                for start, end in split_offsets(fname, args.jobs * 4)]
+            with Pool(args.jobs) as pool:
+                prefixes = (
+                    p for chunk in pool.imap(extract_chunk, jobs)
+                    for p in chunk)
+                # the generator must be drained before the pool is closed
+                for prefix in prefixes:
+                    if prefix not in seen:
+                        seen.add(prefix)
+                        print(prefix)
+        else:
+            with open_dump(fname) as fd:
+                for prefix in extract(fd, asns, versions):
+                    if prefix not in seen:
+                        seen.add(prefix)
+                        print(prefix)
+    print('# %d prefixes originated by %s' % (
+        len(seen), ' '.join('AS%d' % (a,) for a in sorted(asns))))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        description='Read MRT TABLE_DUMP_V2 RIB dumps and output every prefix '
+        'originated by any of the given ASNs, one per line. The output can be '
+        'given directly to ip-exclude.py.')
+    parser.add_argument(
+        '-a', '--asn', type=parse_asn, action='append', required=True,
+        help='An origin ASN to look for, like AS16276 or 16276. Can be given '
+        'more than once')
+    parser.add_argument(
+        '-f', '--family', type=int, choices=(4, 6),
+        help='Only output prefixes of this IP version. Default is both')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='Number of worker processes to split each uncompressed dump '
+        'across. Compressed dumps are always read by one process')
+    parser.add_argument(
+        'dump', nargs='+',
+        help='MRT dump file(s). May be compressed with gzip or bzip2')
+    args = parser.parse_args()
+    try:
+        main(args)
+    except KeyboardInterrupt:
+        print()
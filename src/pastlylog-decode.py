@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+''' Turn the binary logs written by PastlyLogger(binary=True) back into the
+text PastlyLogger would have written, optionally keeping only some levels and
+a range of time.
+
+    ./pastlylog-decode.py -l warn --since '2026-10-17 12:00' debug.log.bin
+
+Records are decoded and written out one at a time, so it works on logs of any
+size and on logs that are still being written. Rotated logs that have been
+gzipped can be given as-is. '''
+import gzip
+import sys
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from datetime import datetime
+
+from pastlylogger import LEVELS, format_binary_record, read_binary
+
+
+def parse_time(s):
+    ''' Turn a Unix timestamp or an ISO 8601 date and time (in local time,
+    unless it says otherwise) into nanoseconds since the epoch '''
+    try:
+        return int(float(s) * 1000000000)
+    except ValueError:
+        return int(datetime.fromisoformat(s).timestamp() * 1000000000)
+
+
+def open_log(fname):
+    if fname == '-':
+        return sys.stdin.buffer
+    if fname.endswith('.gz'):
+        return gzip.open(fname, 'rb')
+    return open(fname, 'rb')
+
+
+def main(args):
+    levels = set(LEVELS[LEVELS.index(args.level):])
+    out = sys.stdout
+    for fname in args.log:
+        with open_log(fname) as fd:
+            for flags, wall_ns, level, thread, s in read_binary(fd):
+                # levels other than the standard ones have no order, so
+                # they're always output
+                if level in LEVELS and level not in levels:
+                    continue
+                if args.since is not None and wall_ns < args.since:
+                    continue
+                if args.until is not None and wall_ns >= args.until:
+                    continue
+                out.write(format_binary_record(
+                    flags, wall_ns, level, thread, s))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        description='Decode binary PastlyLogger logs to text on stdout')
+    parser.add_argument(
+        '-l', '--level', choices=LEVELS, default='debug',
+        help='Only output messages at this level or a more severe one. '
+        'Messages logged with a nonstandard level are always output')
+    parser.add_argument(
+        '--since', type=parse_time,
+        help='Only output messages logged at or after this time. A Unix '
+        'timestamp or a date and time like 2026-10-17T12:00:00')
+    parser.add_argument(
+        '--until', type=parse_time,
+        help='Only output messages logged before this time')
+    parser.add_argument(
+        'log', nargs='*', default=['-'],
+        help='Binary log file(s), possibly gzipped. Default is stdin')
+    args = parser.parse_args()
+    try:
+        main(args)
+    except KeyboardInterrupt:
+        print()
@@ -1,5 +1,706 @@
+import atexit
+from collections import OrderedDict, deque
 from datetime import datetime
-from threading import Lock, current_thread
+from functools import partial
+import gzip
+import marshal
+import os
+from queue import Queue
+import re
+import shutil
+import struct
+import sys
+from threading import Condition, Event, Lock, Thread, current_thread
+import time
+
+LEVELS = ['debug', 'info', 'notice', 'warn', 'error']
+# what rotation adds to a log file's name: a timestamp, a counter if there was
+# already a file with that timestamp, and .gz once it has been compressed
+ROTATED_SUFFIX = r'\.\d{8}-\d{6}(-\d+)?(\.gz)?$'
+
+# The binary format is a sequence of records, each a 5 byte prefix (payload
+# length, record type) followed by the payload:
+#   header: magic, version, flags, wall clock ns, monotonic ns, pid
+#     Written whenever the file is opened. Log records' monotonic timestamps
+#     are turned into dates using the header before them.
+#   thread: native thread id, then the thread's name in UTF-8
+#     Written the first time a thread logs to the file.
+#   string: string id, then the string in UTF-8
+#     Written the first time a string is the first argument of a log call,
+#     which is usually a constant message or format string.
+#   log: monotonic ns, level (index into LEVELS), native thread id, id of the
+#     first argument or -1 if it isn't a known string, then the rest of the
+#     arguments as a tuple serialized with marshal. Arguments marshal can't
+#     handle are stored as str() of themselves. A level that isn't in LEVELS
+#     is stored as LEVEL_OTHER, with its name as an extra last argument.
+BINARY_MAGIC = b'PLOG'
+BINARY_VERSION = 1
+MARSHAL_VERSION = 4
+REC_HEADER, REC_THREAD, REC_STRING, REC_LOG = 0, 1, 2, 3
+FLAG_LEVELS, FLAG_THREADS, FLAG_DATE, FLAG_PRINTF = 1, 2, 4, 8
+LEVEL_OTHER = 255
+# most first arguments to remember per file
+MAX_STRINGS = 4096
+_PREFIX = struct.Struct('<IB')
+_HEADER = struct.Struct('<4sBBqqI')
+_ID = struct.Struct('<I')
+_LOG = struct.Struct('<qBIi')
+_PREFIX_LOG = struct.Struct('<IBqBIi')
+# how many rate limiting keys to have before forgetting the least recently
+# used one
+MAX_BUCKETS = 10000
+
+class _CoarseClock:
+    """
+    Formats timestamps the way str(datetime) does, but only builds a datetime
+    once per second. The rest of the second's timestamps reuse its text and
+    just add the microseconds.
+    """
+    def __init__(self):
+        # (second, text) kept as one tuple so threads always see a matching
+        # pair
+        self._cached = (None, None)
+
+    def __call__(self, t=None):
+        if t is None: t = time.time()
+        sec = int(t)
+        cached_sec, text = self._cached
+        if sec != cached_sec:
+            text = datetime.fromtimestamp(sec).strftime('%Y-%m-%d %H:%M:%S')
+            self._cached = (sec, text)
+        return '{}.{:06d}'.format(text, int((t - sec) * 1000000))
+
+def _format_line(log_levels, log_threads, log_date, printf_style, level, date,
+        thread, s):
+    prefix = []
+    if log_date: prefix.append('[{}]'.format(date))
+    if log_levels: prefix.append('[{}]'.format(level))
+    if log_threads: prefix.append('[{}]'.format(thread))
+    prefix = ' '.join(prefix)
+    if printf_style and len(s) > 1:
+        # binary logs are formatted long after the call, so a bad record
+        # can't be allowed to stop the decoding of the rest of the file
+        try: s = s[0] % s[1:]
+        except Exception as e:
+            s = 'Unable to format {} log message {!r}: {}: {}'.format(
+                level, s, type(e).__name__, e)
+    else: s = ' '.join([ str(s_) for s_ in s ])
+    if prefix: s = ' '.join([ prefix, s ])
+    return '{}\n'.format(s)
+
+class _TextFormat:
+    """
+    Turns log records into lines of text. Records are timestamped with
+    time.time() and given the calling thread, or None if thread names aren't
+    logged.
+    """
+    binary = False
+    stamp = staticmethod(time.time)
+
+    def __init__(self, log_levels, log_threads, log_date, printf_style):
+        self.format_line = partial(_format_line, log_levels, log_threads,
+            log_date, printf_style)
+        self.clock = _CoarseClock()
+
+    def header(self):
+        return None
+
+    def __call__(self, level, t, thread, s):
+        return self.format_line(level, self.clock(t),
+            thread.name if thread else None, s)
+
+class _BinaryFormat:
+    """
+    Turns log records into the binary format described at the top of this
+    file. Records are timestamped with time.monotonic_ns(), which is much
+    cheaper than making a date, and their arguments are serialized in one go
+    by marshal instead of being formatted.
+
+    Each file gets its own _BinaryFormat, which remembers the thread names and
+    strings it has written. header() repeats all of them, so a rotated file
+    has everything needed to decode it. Records must be written in the order
+    they're formatted, since one may use a string defined by the one before.
+
+    Several processes writing to one file would give the same string id
+    different meanings, so intern_strings must be off for multiprocess mode.
+    Thread ids are unique across processes, so they're fine.
+    """
+    binary = True
+    stamp = staticmethod(time.monotonic_ns)
+
+    def __init__(self, log_levels, log_threads, log_date, printf_style,
+            intern_strings=True):
+        self.flags = (FLAG_LEVELS if log_levels else 0) | \
+            (FLAG_THREADS if log_threads else 0) | \
+            (FLAG_DATE if log_date else 0) | \
+            (FLAG_PRINTF if printf_style else 0)
+        self.threads = {}
+        self.strings = {}
+        self.intern_strings = intern_strings
+
+    def header(self):
+        payload = _HEADER.pack(BINARY_MAGIC, BINARY_VERSION, self.flags,
+            time.time_ns(), time.monotonic_ns(), os.getpid())
+        out = [_PREFIX.pack(len(payload), REC_HEADER), payload]
+        for tid, name in list(self.threads.items()):
+            out.append(_id_record(REC_THREAD, tid, name))
+        for s, sid in list(self.strings.items()):
+            out.append(_id_record(REC_STRING, sid, s))
+        return b''.join(out)
+
+    def __call__(self, level, t, thread, s):
+        out = b''
+        tid = 0
+        if thread:
+            tid = thread.native_id
+            if tid not in self.threads:
+                self.threads[tid] = thread.name
+                out += _id_record(REC_THREAD, tid, thread.name)
+        sid = -1
+        if s and type(s[0]) is str and self.intern_strings:
+            sid = self.strings.get(s[0], -1)
+            if sid < 0 and len(self.strings) < MAX_STRINGS:
+                sid = self.strings[s[0]] = len(self.strings)
+                out += _id_record(REC_STRING, sid, s[0])
+            if sid >= 0: s = s[1:]
+        if level in LEVELS: level = LEVELS.index(level)
+        else: level, s = LEVEL_OTHER, s + (str(level),)
+        try:
+            args = marshal.dumps(s, MARSHAL_VERSION)
+        except ValueError:
+            args = marshal.dumps(tuple(a if type(a) in (int, float, str)
+                else str(a) for a in s), MARSHAL_VERSION)
+        return out + _PREFIX_LOG.pack(_LOG.size + len(args), REC_LOG, t,
+            level, tid, sid) + args
+
+def _id_record(typ, i, s):
+    s = s.encode('utf-8')
+    return _PREFIX.pack(_ID.size + len(s), typ) + _ID.pack(i) + s
+
+def read_binary(fd):
+    """
+    Yield (flags, wall clock ns, level, thread name, args) for each log record
+    in the given binary file-like object written by PastlyLogger(binary=True).
+    The thread name is None if thread names weren't logged, or the thread id
+    as a string if its name is unknown. Stops quietly at a truncated record
+    at the end, which is what a crash in the middle of a write leaves.
+
+    The arguments are unmarshalled, so only read files you trust.
+    """
+    flags, offset, threads, strings = None, None, {}, {}
+    while True:
+        prefix = fd.read(_PREFIX.size)
+        if len(prefix) < _PREFIX.size: return
+        length, typ = _PREFIX.unpack(prefix)
+        payload = fd.read(length)
+        if len(payload) < length: return
+        if typ == REC_HEADER:
+            magic, version, flags, wall, mono, _ = _HEADER.unpack(payload)
+            if magic != BINARY_MAGIC or version != BINARY_VERSION:
+                raise ValueError('Not a PastlyLogger binary log, or an '
+                    'unsupported version of one')
+            offset = wall - mono
+        elif typ == REC_THREAD or typ == REC_STRING:
+            table = threads if typ == REC_THREAD else strings
+            table[_ID.unpack_from(payload)[0]] = \
+                str(payload[_ID.size:], 'utf-8', 'replace')
+        elif typ == REC_LOG:
+            if flags is None:
+                raise ValueError('Log record before the first header')
+            mono, level, tid, sid = _LOG.unpack_from(payload)
+            args = marshal.loads(payload[_LOG.size:])
+            if sid >= 0: args = (strings.get(sid, '?'),) + args
+            if level == LEVEL_OTHER: level, args = args[-1], args[:-1]
+            else: level = LEVELS[level]
+            thread = None
+            if flags & FLAG_THREADS: thread = threads.get(tid, str(tid))
+            yield flags, mono + offset, level, thread, args
+
+def format_binary_record(flags, wall_ns, level, thread, args):
+    """
+    Return the line of text PastlyLogger would have written for a record
+    from read_binary(), had it been logging text. Arguments that weren't
+    ints, floats, strings, bytes, or containers of them were stored as their
+    str(), so %r in a printf-style format shows the repr of that string.
+    """
+    date = datetime.fromtimestamp(wall_ns // 1000 / 1000000)
+    return _format_line(flags & FLAG_LEVELS, flags & FLAG_THREADS,
+        flags & FLAG_DATE, flags & FLAG_PRINTF, level, date, thread, args)
+
+def _disabled(*s, level=None):
+    return None
+
+def _make_level_method(fd, level, writer, log_threads):
+    """
+    Return the function that logs at the given level to the given _LogFile, or
+    a no-op if the level's messages go nowhere. It doesn't reference the
+    PastlyLogger so that storing it on the logger doesn't make a cycle. Like
+    the old level methods, it takes a level keyword to label the message with
+    a different level than the one it's logged at.
+    """
+    if fd is None:
+        return _disabled
+    stamp = fd.fmt.stamp
+    if writer:
+        put = writer.put
+        def log(*s, level=level):
+            return put((fd, stamp(), level,
+                current_thread() if log_threads else None, s))
+        return log
+    log_record = fd.log
+    def log(*s, level=level):
+        return log_record(level, stamp(),
+            current_thread() if log_threads else None, s)
+    return log
+
+class _RateLimiter:
+    """
+    A token bucket per key that lets through at most rate messages a second
+    on average, in bursts of up to burst. The key is the call site if by_site,
+    else the level and first argument (the message or format string).
+
+    How many were dropped is written when the key is next let through, when
+    its bucket is evicted to make room for a new key, or on flush. At most
+    MAX_BUCKETS buckets are kept, the least recently used being evicted
+    first. Lifetime counts are kept for at most MAX_BUCKETS keys; drops of
+    any more are counted together in suppressed_other.
+    """
+    def __init__(self, rate, burst, by_site):
+        self.rate = rate
+        self.burst = burst if burst else max(1, rate)
+        self.by_site = by_site
+        # key: [tokens, time of last refill, suppressed since last allowed,
+        # function to log how many were suppressed with], least recently used
+        # first
+        self.buckets = OrderedDict()
+        # key: suppressed ever
+        self.suppressed = {}
+        self.suppressed_other = 0
+        self.total = 0
+        self.lock = Lock()
+
+    def allow(self, key, log):
+        """
+        Return None if the message with the given key should be dropped, else
+        how many messages with the key were dropped since the last one that
+        wasn't. log is what flush() should write any drops not yet reported
+        with.
+        """
+        now = time.monotonic()
+        evicted = None
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= MAX_BUCKETS:
+                    old_key, old = self.buckets.popitem(last=False)
+                    if old[2]: evicted = (old_key, old[2], old[3])
+                bucket = self.buckets[key] = [self.burst, now, 0, log]
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(self.burst,
+                    bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                bucket[3] = log
+                if key in self.suppressed or \
+                        len(self.suppressed) < MAX_BUCKETS:
+                    self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                else:
+                    self.suppressed_other += 1
+                self.total += 1
+                missed = None
+            else:
+                bucket[0] -= 1
+                missed, bucket[2] = bucket[2], 0
+        if evicted: self._report(*evicted)
+        return missed
+
+    def _report(self, key, missed, log):
+        a, b = key
+        if self.by_site:
+            log('{} messages from {}:{} were rate limited'.format(
+                missed, a, b))
+        else:
+            log('{} {} messages like {!r} were rate limited'.format(
+                missed, a, b))
+
+    def flush(self):
+        """
+        Write how many messages were dropped for every key that hasn't been
+        let through since
+        """
+        with self.lock:
+            pending = []
+            for key, bucket in self.buckets.items():
+                if bucket[2]:
+                    pending.append((key, bucket[2], bucket[3]))
+                    bucket[2] = 0
+        for key, missed, log in pending: self._report(key, missed, log)
+
+class _Collapser:
+    """
+    Drops messages with the same level and arguments as the message before
+    them in the same file, and counts them. A "last message repeated N times"
+    line is written when a different message comes along, or on flush.
+    """
+    def __init__(self):
+        # file: [level, args, times repeated, log function]
+        self.last = {}
+        self.total = 0
+        self.lock = Lock()
+
+    def check(self, fd, level, s, log):
+        """
+        Return whether the message should be written. If it should and it ends
+        a run of repeats, say how long the run was first.
+        """
+        with self.lock:
+            last = self.last.get(fd)
+            if last and last[0] == level and _same_args(last[1], s):
+                last[2] += 1
+                self.total += 1
+                return False
+            self.last[fd] = [level, s, 0, log]
+        if last and last[2]: _log_repeats(last)
+        return True
+
+    def flush(self):
+        with self.lock:
+            pending = [last for last in self.last.values() if last[2]]
+            self.last = {}
+        for last in pending: _log_repeats(last)
+
+def _log_repeats(last):
+    last[3]('last message repeated {} times'.format(last[2]))
+
+def _same_args(a, b):
+    try:
+        return a == b
+    except Exception:
+        # things like numpy arrays can't say whether they're equal
+        return False
+
+def _limit(log, fd, level, limiter, collapser):
+    """
+    Wrap the given level method with rate limiting and/or collapsing of
+    repeated messages. What they write about the messages they drop is
+    written with log directly.
+    """
+    by_site = limiter and limiter.by_site
+    def limited(*s, level=level):
+        if limiter:
+            if by_site:
+                frame = sys._getframe(1)
+                if frame.f_code is PastlyLogger.__call__.__code__:
+                    frame = frame.f_back
+                key = (frame.f_code.co_filename, frame.f_lineno)
+            else:
+                key = (level, s[0] if s else None)
+            try:
+                missed = limiter.allow(key, log)
+            except TypeError:
+                # unhashable first argument
+                missed = limiter.allow((level, None), log)
+            if missed is None: return None
+            if missed:
+                log('{} messages like the next one were rate limited'
+                    .format(missed))
+        if collapser and not collapser.check(fd, level, s, log): return None
+        return log(*s, level=level)
+    return limited
+
+class _LogFile:
+    """
+    A log file, the lock that serializes writes to it, and the format (a
+    _TextFormat or _BinaryFormat) of what's written to it. Every level that
+    logs to the same file name shares one _LogFile.
+
+    If rotate_size or rotate_interval is given, the file is rotated before a
+    write that would make it hold more than rotate_size bytes, or the first
+    write after the wall clock passes a multiple of rotate_interval seconds.
+    Rotating renames the file to path.YYYYmmdd-HHMMSS and opens a new one. The
+    old one is handed to worker to be compressed and pruned, so the write that
+    rotates doesn't wait for that.
+    """
+    def __init__(self, path, mode, buffering, fmt, rotate_size=None,
+            rotate_interval=None, worker=None):
+        self.path = path
+        self.fmt = fmt
+        self.buffering = buffering
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self.rotating = bool(rotate_size or rotate_interval)
+        self.worker = worker
+        self.lock = Lock()
+        self._open(mode)
+
+    def _open(self, mode):
+        if self.fmt.binary: mode += 'b'
+        self.fd = open(self.path, mode, buffering=self.buffering)
+        self.size = self.fd.tell()
+        header = self.fmt.header()
+        if header:
+            self.fd.write(header)
+            self.size += len(header)
+        if self.rotate_interval:
+            self.next_rotate = self.rotate_interval * \
+                (time.time() // self.rotate_interval + 1)
+
+    def _should_rotate(self, n):
+        if self.rotate_size and self.size and \
+                self.size + n > self.rotate_size:
+            return True
+        if self.rotate_interval and time.time() >= self.next_rotate:
+            return True
+        return False
+
+    def _rotate(self):
+        if not self.size:
+            # nothing to keep, just start a new interval
+            if self.rotate_interval:
+                self.next_rotate = self.rotate_interval * \
+                    (time.time() // self.rotate_interval + 1)
+            return
+        self.fd.close()
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        dest, n = '{}.{}'.format(self.path, stamp), 0
+        while os.path.exists(dest) or os.path.exists(dest + '.gz'):
+            n += 1
+            dest = '{}.{}-{}'.format(self.path, stamp, n)
+        try:
+            os.rename(self.path, dest)
+        except OSError:
+            # keep appending to the same file rather than lose messages
+            dest = None
+        self._open('a')
+        if dest and self.worker: self.worker.submit(dest, self.path)
+
+    def _write(self, s):
+        # size is in bytes, so count what non-ASCII text encodes to
+        n = len(s) if self.fmt.binary or s.isascii() \
+            else len(s.encode(self.fd.encoding))
+        if self.rotating and self._should_rotate(n): self._rotate()
+        self.fd.write(s)
+        self.size += n
+
+    def write(self, s):
+        with self.lock: self._write(s)
+
+    def log(self, level, t, thread, s):
+        # formatted under the lock so records are written in the order they
+        # were formatted
+        with self.lock: self._write(self.fmt(level, t, thread, s))
+
+    def flush(self):
+        with self.lock: self.fd.flush()
+
+    def close(self):
+        with self.lock:
+            if not self.fd.closed: self.fd.close()
+
+class _AppendFile:
+    """
+    A log file that several processes can write to at once. It's opened with
+    O_APPEND and every write is a single os.write of the whole record (or
+    batch of records), which the kernel appends to a regular file in one
+    piece. Writes from different processes and threads never interleave, so
+    no lock is needed. Nothing is buffered, so flush does nothing.
+
+    Has the same interface as _LogFile, minus rotation.
+    """
+    def __init__(self, path, mode, fmt):
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+        if mode == 'w': flags |= os.O_TRUNC
+        self.path = path
+        self.fmt = fmt
+        self.fd = os.open(path, flags, 0o666)
+        self.lock = Lock()
+        header = fmt.header()
+        if header: self.write(header)
+
+    def write(self, s):
+        data = s if self.fmt.binary else s.encode('utf-8')
+        n = os.write(self.fd, data)
+        # only short on errors like a full disk; write the rest anyway
+        while n < len(data):
+            data = data[n:]
+            n = os.write(self.fd, data)
+
+    def log(self, level, t, thread, s):
+        self.write(self.fmt(level, t, thread, s))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None: os.close(self.fd)
+            self.fd = None
+
+class _RotationWorker:
+    """
+    Background thread that gzips rotated log files and then removes all but
+    the keep newest rotated files of that log (all of them if keep is 0, none
+    if keep is None).
+
+    Compression writes to a temporary file that is only renamed to .gz once
+    it's complete, so a process exiting mid-compression leaves the rotated
+    file as it was. Rotated files are ordered by mtime, which compression
+    preserves.
+    """
+    def __init__(self, compress, keep):
+        self.compress = compress
+        self.keep = keep
+        self.jobs = Queue()
+        self.thread = Thread(target=self._run, name='PastlyLogger-rotation',
+            daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def submit(self, rotated, path):
+        self.jobs.put((rotated, path))
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None: return
+            rotated, path = job
+            if self.compress: self._compress(rotated)
+            if self.keep is not None: self._prune(path)
+
+    def _compress(self, fname):
+        tmp = fname + '.gz.tmp'
+        try:
+            with open(fname, 'rb') as fd_in, gzip.open(tmp, 'wb') as fd_out:
+                shutil.copyfileobj(fd_in, fd_out, 1024*1024)
+            shutil.copystat(fname, tmp)
+            os.rename(tmp, fname + '.gz')
+            os.unlink(fname)
+        except OSError:
+            if os.path.exists(tmp): os.unlink(tmp)
+
+    def _prune(self, path):
+        dname, base = os.path.split(path)
+        dname = dname or '.'
+        pattern = re.compile(re.escape(base) + ROTATED_SUFFIX)
+        rotated = []
+        for name in os.listdir(dname):
+            if not pattern.match(name): continue
+            fname = os.path.join(dname, name)
+            try: rotated.append((os.stat(fname).st_mtime, fname))
+            except OSError: pass
+        rotated.sort()
+        for _, fname in rotated[:max(0, len(rotated) - self.keep)]:
+            try: os.unlink(fname)
+            except OSError: pass
+
+    def close(self):
+        atexit.unregister(self.close)
+        self.jobs.put(None)
+        if self.thread is not current_thread(): self.thread.join()
+
+def _format_record(fmt, level, t, thread, s):
+    """
+    Return fmt(level, t, thread, s). If the record can't be formatted (say,
+    an argument whose str() raises), return a line saying so with the
+    record's repr() instead, like logging.Handler.handleError, so one bad
+    record doesn't take the rest of its batch with it.
+    """
+    try:
+        return fmt(level, t, thread, s)
+    except Exception as e:
+        return fmt(level, t, thread,
+            ('Unable to format {} log message {!r}: {}: {}'.format(
+            level, s, type(e).__name__, e),))
+
+class _AsyncWriter:
+    """
+    Background thread that writes log records for PastlyLogger's async mode.
+
+    Callers append records to a deque, which is safe without a lock. The
+    thread wakes up every interval seconds (or sooner if asked), takes
+    everything in the deque, and does one write and flush per file for the
+    whole batch.
+
+    If the queue holds queue_size records, on_full decides what callers do:
+    'block' until the writer makes room, or 'drop' the record and count it.
+
+    The thread holds no reference to the PastlyLogger, so the logger can still
+    be garbage collected (and its __del__ run) while the thread is alive.
+    """
+    def __init__(self, queue_size, on_full, interval):
+        assert on_full in ['block', 'drop']
+        self.queue = deque()
+        self.queue_size = queue_size
+        self.on_full = on_full
+        self.interval = interval
+        self.dropped = 0
+        self.stopping = False
+        self.wake = Event()
+        self.space = Condition()
+        self.thread = Thread(target=self._run, name='PastlyLogger-writer',
+            daemon=True)
+        self.thread.start()
+        # make sure everything gets written even if nobody calls close()
+        atexit.register(self.close)
+
+    def put(self, record):
+        if len(self.queue) >= self.queue_size:
+            if self.on_full == 'drop':
+                self.dropped += 1
+                return
+            with self.space:
+                while len(self.queue) >= self.queue_size and \
+                        self.thread.is_alive():
+                    self.wake.set()
+                    self.space.wait(self.interval)
+        self.queue.append(record)
+
+    def _run(self):
+        while not self.stopping:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self._drain()
+        self._drain()
+
+    def _drain(self):
+        batches, flushed = {}, []
+        queue = self.queue
+        try:
+            while queue:
+                record = queue.popleft()
+                # flush() asks to be told when everything before it is written
+                if isinstance(record, Event):
+                    flushed.append(record)
+                    continue
+                fd, t, level, thread, s = record
+                if fd not in batches: batches[fd] = []
+                batches[fd].append(_format_record(fd.fmt, level, t, thread, s))
+            for fd, lines in batches.items():
+                # lines are all str or all bytes, depending on the file's
+                # format
+                fd.write(lines[0][:0].join(lines))
+                fd.flush()
+        finally:
+            # even if a write failed, nobody should wait on us forever
+            for ev in flushed: ev.set()
+            with self.space: self.space.notify_all()
+
+    def flush(self):
+        ev = Event()
+        self.queue.append(ev)
+        self.wake.set()
+        while not ev.wait(self.interval):
+            if not self.thread.is_alive():
+                return self._drain()
+
+    def close(self):
+        atexit.unregister(self.close)
+        self.stopping = True
+        self.wake.set()
+        if self.thread is not current_thread(): self.thread.join()
+
 class PastlyLogger:
     """
     PastlyLogger - logging class inspired by Tor's logging API
@@ -28,135 +729,321 @@ class PastlyLogger:
 
     default tells the logger what level to log at when called with
     log('foobar') instead of log.info('foobar')
+
+    async_mode tells the logger to hand records to a background thread that
+    formats and writes them in batches, one write per file per batch, instead
+    of writing each one on the calling thread. Records are written at least
+    every async_interval seconds, and flush() waits until everything logged
+    before it is written.
+
+    queue_size is how many records async_mode may have waiting to be written.
+    When it is reached, queue_full says whether to 'block' the caller until
+    there is room or 'drop' the record. num_dropped() says how many have been
+    dropped.
+
+    rotate_size and rotate_interval turn on log rotation: a file is renamed
+    to name.YYYYmmdd-HHMMSS and started over when it would grow past
+    rotate_size bytes, or at every multiple of rotate_interval seconds
+    (counted from the Unix epoch, so 3600 rotates on the hour). Rotation
+    happens when a message is written, so a file nobody writes to isn't
+    rotated. Rotated files are gzipped in the background if rotate_compress
+    is set, and all but the rotate_keep newest are deleted if it is given.
+    Rotation can't be used with multiprocess.
+
+    Levels that log to the same file share one open file and lock, even if
+    they name it differently (foo.txt, ./foo.txt, a symlink to it). That keeps
+    their lines from interleaving, and rotating the file doesn't leave any of
+    them writing to the old one.
+
+    multiprocess makes it safe for several processes to log to the same files.
+    Each record is written with one os.write to a file opened with O_APPEND,
+    so records from different processes never interleave. A logger may be
+    created before forking, unless it's also in async_mode, whose writer
+    thread only exists in the process that created it.
+
+    printf_style tells the logger to treat a call with more than one argument
+    as a %-format string and its arguments, like log.info('got %d bytes', n),
+    instead of joining the arguments with spaces. Either way the message is
+    only built if it is going to be written, so pass values as arguments
+    rather than formatting them yourself.
+
+    binary tells the logger to write a compact binary format instead of text:
+    a monotonic timestamp, the level as a byte, the thread id, and the
+    arguments as typed values, with nothing formatted. pastlylog-decode.py
+    turns it back into the text the logger would otherwise have written.
+
+    rate_limit turns on rate limiting: each message (level and first argument,
+    which is the format string in printf_style) may be logged at most
+    rate_limit times a second on average, in bursts of up to rate_burst
+    (default: rate_limit). If rate_limit_by is 'site', the limit is per line
+    of code that logs instead. Once a message is let through again, it's
+    preceded by a line saying how many like it were dropped. Drops that
+    haven't been reported that way yet are on flush() and when the logger is
+    deleted.
+
+    collapse_repeats drops messages identical to the one before them in the
+    same file, and writes "last message repeated N times" when a different
+    one comes along or on flush().
+
+    counters() says how many messages were rate limited, collapsed, or
+    dropped by a full async queue.
+
+    Where each level's messages go is worked out once, here. A level whose
+    messages are lost is a no-op that doesn't look at its arguments.
     """
     def __init__(self, error=None, warn=None, notice=None,
         info=None, debug=None, overwrite=[], log_threads=False,
-        default='notice', log_levels=True, log_date=True):
+        default='notice', log_levels=True, log_date=True,
+        async_mode=False, queue_size=100000, queue_full='block',
+        async_interval=0.1, printf_style=False, rotate_size=None,
+        rotate_interval=None, rotate_keep=None, rotate_compress=True,
+        multiprocess=False, binary=False, rate_limit=None, rate_burst=None,
+        rate_limit_by='message', collapse_repeats=False):
 
         self.log_threads = log_threads
         self.log_levels = log_levels
         self.log_date = log_date
-        assert default in ['debug','info','notice','warn','error']
+        self.printf_style = printf_style
+        assert default in LEVELS
         self.default_level = default
+        # Text files can share a format. Binary ones each need their own. The
+        # formats don't reference this object, so neither the writer thread
+        # nor the level methods keep it alive.
+        fmt_args = (log_levels, log_threads, log_date, printf_style)
+        text_fmt = _TextFormat(*fmt_args)
+        self._writer = None
+        if async_mode:
+            self._writer = _AsyncWriter(queue_size, queue_full,
+                async_interval)
 
-        # buffering=1 means line-based buffering
-        if error:
-            self.error_fd = open(error, 'w' if 'error' in overwrite else 'a',
-                buffering=1)
-            self.error_fd_mutex = Lock()
-        else:
-            self.error_fd = None
-            self.error_fd_mutex = None
-        if warn:
-            self.warn_fd = open(warn, 'w' if 'warn' in overwrite else 'a',
-                buffering=1)
-            self.warn_fd_mutex = Lock()
-        else:
-            self.warn_fd = None
-            self.warn_fd_mutex = None
-        if notice:
-            self.notice_fd = open(notice, 'w' if 'notice' in overwrite else 'a',
-                buffering=1)
-            self.notice_fd_mutex = Lock()
-        else:
-            self.notice_fd = None
-            self.notice_fd_mutex = None
-        if info:
-            self.info_fd = open(info, 'w' if 'info' in overwrite else 'a',
-                buffering=1)
-            self.info_fd_mutex = Lock()
-        else:
-            self.info_fd = None
-            self.info_fd_mutex = None
-        if debug:
-            self.debug_fd = open(debug, 'w' if 'debug' in overwrite else 'a',
-                buffering=1)
-            self.debug_fd_mutex = Lock()
-        else:
-            self.debug_fd = None
-            self.debug_fd_mutex = None
+        assert not (multiprocess and (rotate_size or rotate_interval))
+        assert rate_limit_by in ['message', 'site']
+        self._limiter = None
+        if rate_limit:
+            self._limiter = _RateLimiter(rate_limit, rate_burst,
+                rate_limit_by == 'site')
+        self._collapser = _Collapser() if collapse_repeats else None
+        self._rotation = None
+        if (rotate_size or rotate_interval) and \
+                (rotate_compress or rotate_keep is not None):
+            self._rotation = _RotationWorker(rotate_compress, rotate_keep)
+
+        # buffering=1 means line-based buffering, and 0 means none, for binary
+        # files. In async mode whole batches are written and flushed at once,
+        # so use normal buffering.
+        buffering = -1 if async_mode else 0 if binary else 1
+        paths = {'error': error, 'warn': warn, 'notice': notice, 'info': info,
+            'debug': debug}
+        self._files = {}
+        for level in LEVELS:
+            path = os.path.realpath(paths[level]) if paths[level] else None
+            if path and path not in self._files:
+                # overwrite the file if any level using it asks to
+                mode = 'w' if any(paths.get(l) and
+                    os.path.realpath(paths[l]) == path for l in overwrite) \
+                    else 'a'
+                fmt = _BinaryFormat(*fmt_args, intern_strings=not
+                    multiprocess) if binary else text_fmt
+                if multiprocess:
+                    self._files[path] = _AppendFile(path, mode, fmt)
+                else:
+                    self._files[path] = _LogFile(path, mode, buffering, fmt,
+                        rotate_size, rotate_interval, self._rotation)
+            fd = self._files[path] if path else None
+            setattr(self, level + '_fd', fd)
+            setattr(self, level + '_fd_mutex', fd.lock if fd else None)
+
+        # Resolve the cascade: each level goes to its own file if it has one,
+        # else wherever the next noisiest level goes.
+        fd = None
+        for level in LEVELS:
+            fd = getattr(self, level + '_fd') or fd
+            log = _make_level_method(fd, level, self._writer, log_threads)
+            if fd and (self._limiter or self._collapser):
+                log = _limit(log, fd, level, self._limiter, self._collapser)
+            setattr(self, level, log)
+        self._default = getattr(self, default)
 
         self.debug('Creating PastlyLogger instance')
 
     def __call__(self, *s):
-        if self.default_level == 'debug': return self.debug(*s)
-        elif self.default_level == 'info': return self.info(*s)
-        elif self.default_level == 'notice': return self.notice(*s)
-        elif self.default_level == 'warn': return self.warn(*s)
-        elif self.default_level == 'error': return self.error(*s)
+        return self._default(*s)
 
     def __del__(self):
         self.debug('Deleting PastlyLogger instance')
-        self.flush()
-        if self.error_fd: self.error_fd.close()
-        if self.warn_fd: self.warn_fd.close()
-        if self.notice_fd: self.notice_fd.close()
-        if self.info_fd: self.info_fd.close()
-        if self.debug_fd: self.debug_fd.close()
-        self.error_fd, self.warn_fd = None, None
-        self.notice_fd, self.info_fd, self.debug_fd = None, None, None
-        if self.error_fd_mutex:
-            if not self.error_fd_mutex.acquire(blocking=False):
-                self.error_fd_mutex.release()
-        if self.warn_fd_mutex:
-            if not self.warn_fd_mutex.acquire(blocking=False):
-                self.warn_fd_mutex.release()
-        if self.notice_fd_mutex:
-            if not self.notice_fd_mutex.acquire(blocking=False):
-                self.notice_fd_mutex.release()
-        if self.info_fd_mutex:
-            if not self.info_fd_mutex.acquire(blocking=False):
-                self.info_fd_mutex.release()
-        if self.debug_fd_mutex:
-            if not self.debug_fd_mutex.acquire(blocking=False):
-                self.debug_fd_mutex.release()
-
-    def _log_file(fd, lock, log_levels, log_threads, log_date, level, *s):
-        assert fd
-        prefix = []
-        if log_date: prefix.append('[{}]'.format(datetime.now()))
-        if log_levels: prefix.append('[{}]'.format(level))
-        if log_threads: prefix.append('[{}]'.format(current_thread().name))
-        prefix = ' '.join(prefix)
-        s = ' '.join([ str(s_) for s_ in s ])
-        if prefix: s = ' '.join([ prefix, s ])
-        lock.acquire()
-        fd.write('{}\n'.format(s))
-        lock.release()
+        if self._limiter: self._limiter.flush()
+        if self._collapser: self._collapser.flush()
+        if self._writer: self._writer.close()
+        for fd in self._files.values(): fd.close()
+        # let any rotated files finish compressing
+        if self._rotation: self._rotation.close()
+
+    def num_dropped(self):
+        return self._writer.dropped if self._writer else 0
+
+    def counters(self):
+        """
+        Return a dict with how many messages were dropped by rate limiting
+        ('rate_limited'), by collapsing repeats ('collapsed'), and by a full
+        async queue ('dropped'). 'rate_limited_by' breaks down 'rate_limited'
+        by 'level: message' or 'file:line', with 'other' for anything past
+        the first MAX_BUCKETS of them.
+        """
+        counters = {'rate_limited': 0, 'rate_limited_by': {},
+            'collapsed': 0, 'dropped': self.num_dropped()}
+        if self._limiter:
+            with self._limiter.lock:
+                counters['rate_limited'] = self._limiter.total
+                suppressed = list(self._limiter.suppressed.items())
+                other = self._limiter.suppressed_other
+            for (a, b), n in suppressed:
+                key = '{}:{}'.format(a, b) if self._limiter.by_site \
+                    else '{}: {}'.format(a, b)
+                counters['rate_limited_by'][key] = n
+            if other: counters['rate_limited_by']['other'] = other
+        if self._collapser: counters['collapsed'] = self._collapser.total
+        return counters
 
     def flush(self):
-        if self.error_fd: self.error_fd.flush()
-        if self.warn_fd: self.warn_fd.flush()
-        if self.notice_fd: self.notice_fd.flush()
-        if self.info_fd: self.info_fd.flush()
-        if self.debug_fd: self.debug_fd.flush()
-
-    def debug(self, *s, level='debug'):
-        if self.debug_fd: return PastlyLogger._log_file(
-                self.debug_fd, self.debug_fd_mutex, self.log_levels,
-                self.log_threads, self.log_date, level, *s)
-        return None
+        if self._limiter: self._limiter.flush()
+        if self._collapser: self._collapser.flush()
+        if self._writer: self._writer.flush()
+        for fd in self._files.values(): fd.flush()
+
+    # The level methods are replaced in __init__ by functions that log
+    # straight to the right file. These are only here to document them.
+    def debug(self, *s, level='debug'): pass
+    def info(self, *s, level='info'): pass
+    def notice(self, *s, level='notice'): pass
+    def warn(self, *s, level='warn'): pass
+    def error(self, *s, level='error'): pass
+
+def _benchmark(args):
+    ''' Print calls per second to an enabled and a disabled level, and how
+    big each enabled call's record is '''
+    from itertools import count
+    import tempfile
+    from timeit import timeit
+    with tempfile.TemporaryDirectory() as tmp:
+        for async_mode in [False, True]:
+            for binary in [False, True]:
+                fname = os.path.join(tmp, 'bench-{}-{}.log'.format(
+                    async_mode, binary))
+                log = PastlyLogger(info=fname, async_mode=async_mode,
+                    printf_style=args.printf_style, binary=binary,
+                    rate_limit=args.rate_limit,
+                    rate_limit_by=args.rate_limit_by,
+                    collapse_repeats=args.collapse_repeats)
+                # the number changes so that no two messages are the same
+                n = count()
+                if args.printf_style:
+                    msg = lambda level: level('got %d bytes from %s',
+                        next(n), 'foo')
+                else:
+                    msg = lambda level: level('got', next(n), 'bytes from',
+                        'foo')
+                mode = '{} {}'.format('async' if async_mode else 'sync',
+                    'binary' if binary else 'text')
+                for name, level in [('enabled', log.info),
+                        ('disabled', log.debug)]:
+                    secs = timeit(lambda: msg(level), number=args.calls)
+                    if level is log.info: log.flush()
+                    print('{:12s} {:8s} {:12,.0f} calls/s'.format(
+                        mode, name, args.calls / secs), end='')
+                    if level is log.info:
+                        print(' {:6.1f} bytes/record'.format(
+                            os.path.getsize(fname) / args.calls), end='')
+                    print()
+                del log
+
+def _stress_process(fname, args, proc):
+    log = PastlyLogger(info=fname, log_threads=True,
+        multiprocess=not args.no_multiprocess, async_mode=args.async_mode,
+        binary=args.binary)
+    pad = 'x' * args.line_length
+    def work(thread):
+        for n in range(args.lines):
+            log.info('p{} t{} n{}'.format(proc, thread, n), pad)
+    threads = [Thread(target=work, args=(t,)) for t in range(args.threads)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    del log
+
+def _stress(args):
+    ''' Have several processes, each with several threads, log to one file
+    at once, then check that every line is there and none are torn '''
+    from multiprocessing import Process
+    import tempfile
+    line_re = re.compile(r'^\[[^]]*\] \[info\] \[[^]]*\] '
+        r'p(\d+) t(\d+) n(\d+) x{%d}$' % (args.line_length,))
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'stress.log')
+        start = time.time()
+        procs = [Process(target=_stress_process, args=(fname, args, p))
+            for p in range(args.processes)]
+        for p in procs: p.start()
+        for p in procs: p.join()
+        secs = time.time() - start
+        seen, torn = set(), 0
+        with open(fname, 'rb' if args.binary else 'r') as fd:
+            lines = fd
+            if args.binary:
+                lines = (format_binary_record(*r) for r in read_binary(fd))
+            for line in lines:
+                match = line_re.match(line.rstrip('\n'))
+                if match: seen.add(match.groups())
+                else: torn += 1
+    expected = args.processes * args.threads * args.lines
+    print('{} processes x {} threads x {} lines in {:.2f}s ({:,.0f} lines/s)'
+        .format(args.processes, args.threads, args.lines, secs,
+        expected / secs))
+    print('{} good, {} torn, {} missing'.format(len(seen), torn,
+        expected - len(seen)))
+    return 1 if torn or len(seen) != expected else 0
 
-    def info(self, *s, level='info'):
-        if self.info_fd: return PastlyLogger._log_file(
-                self.info_fd, self.info_fd_mutex, self.log_levels,
-                self.log_threads, self.log_date, level, *s)
-        else: return self.debug(*s, level=level)
-
-    def notice(self, *s, level='notice'):
-        if self.notice_fd: return PastlyLogger._log_file(
-                self.notice_fd, self.notice_fd_mutex, self.log_levels,
-                self.log_threads, self.log_date, level, *s)
-        else: return self.info(*s, level=level)
-
-    def warn(self, *s, level='warn'):
-        if self.warn_fd: return PastlyLogger._log_file(
-                self.warn_fd, self.warn_fd_mutex, self.log_levels,
-                self.log_threads, self.log_date, level, *s)
-        else: return self.notice(*s, level=level)
-
-    def error(self, *s, level='error'):
-        if self.error_fd: return PastlyLogger._log_file(
-                self.error_fd, self.error_fd_mutex, self.log_levels,
-                self.log_threads, self.log_date, level, *s)
-        else: return self.warn(*s, level=level)
+if __name__ == '__main__':
+    from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+    import sys
+    parser = ArgumentParser(
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        description='Benchmark and stress test PastlyLogger')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+    p = sub.add_parser('bench', formatter_class=ArgumentDefaultsHelpFormatter,
+        help='Time logging to an enabled and a disabled level, in sync and '
+        'async mode')
+    p.add_argument('-n', '--calls', type=int, default=200000,
+        help='Number of calls to time for each case')
+    p.add_argument('--printf-style', action='store_true',
+        help='Log with %%-style arguments')
+    p.add_argument('--rate-limit', type=float,
+        help='Rate limit each message to this many per second. Use a huge '
+        'number to time the check without dropping anything')
+    p.add_argument('--rate-limit-by', choices=['message', 'site'],
+        default='message', help='What to rate limit by')
+    p.add_argument('--collapse-repeats', action='store_true',
+        help='Collapse repeated messages. The benchmark message never '
+        'repeats, so this times the check')
+    p = sub.add_parser('stress', formatter_class=ArgumentDefaultsHelpFormatter,
+        help='Log to one file from many threads in many processes and check '
+        'that no lines are torn or lost')
+    p.add_argument('-p', '--processes', type=int, default=4,
+        help='Number of processes')
+    p.add_argument('-t', '--threads', type=int, default=4,
+        help='Number of threads per process')
+    p.add_argument('-n', '--lines', type=int, default=10000,
+        help='Number of lines each thread logs')
+    p.add_argument('-l', '--line-length', type=int, default=200,
+        help='Pad each line with this many characters')
+    p.add_argument('--async-mode', action='store_true',
+        help='Use async mode in each process')
+    p.add_argument('--binary', action='store_true',
+        help='Use the binary format')
+    p.add_argument('--no-multiprocess', action='store_true',
+        help='Use normal files instead of multiprocess mode, for comparison')
+    args = parser.parse_args()
+    try:
+        if args.command == 'bench': _benchmark(args)
+        else: sys.exit(_stress(args))
+    except KeyboardInterrupt:
+        print()
@@ -1,83 +1,263 @@
 #!/usr/bin/env python3
 
-import sys, random
-from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+import sys
+from argparse import (ArgumentDefaultsHelpFormatter, ArgumentParser,
+    ArgumentTypeError)
 import matplotlib; matplotlib.use('Agg') # for systems without X11
 from matplotlib.backends.backend_pdf import PdfPages
 import pylab as plt
 import numpy as np
-import random
+import plotdata
 
 plt.rcParams.update({
     'axes.grid' : True,
 })
 
-## helper - cumulative fraction for y axis
-def cf(d): return plt.arange(1.0,float(len(d))+1.0)/float(len(d))
-
-## helper - return step-based CDF x and y values
-def getcdf(data):
+## helper - drop NaNs and sort, once, into a new float array
+def get_sorted(values):
+    data = np.asarray(values, dtype=float)
+    data = data[~np.isnan(data)]
     data.sort()
-    frac = cf(data)
-    x, y, lasty = [], [], 0.0
-    for i in range(len(data)):
-        assert not np.isnan(data[i])
-        x.append(data[i])
-        y.append(lasty)
-        x.append(data[i])
-        y.append(frac[i])
-        lasty = frac[i]
+    return data
+
+## helper - return step-based CDF x and y values of already sorted data.
+## frac is the cumulative fraction at each value, if not evenly spaced
+def getcdf(data, frac=None):
+    n = len(data)
+    x = np.repeat(data, 2)
+    y = np.empty(2 * n)
+    if not n: return x, y
+    if frac is None: frac = np.arange(1, n + 1) / n
+    # each value steps from the previous fraction up to its own
+    y[0] = 0.0
+    y[2::2] = frac[:-1]
+    y[1::2] = frac
     return x, y
 
-def get_all_values_from_fd(fd):
-    values = []
-    for line in fd:
-        line = line.strip()
-        try: values.append(float(line))
-        except: print('ignoring', line)
-    return values
-
-def print_percentiles(label, values):
-    try:
-        from scipy.stats import scoreatpercentile as percentile
-    except ImportError:
-        print('WARN: no scipy means no percentile stats printed')
-        return
-    d = {
-        0: min(values),
-        5: percentile(values, 5),
-        25: percentile(values, 25),
-        50: percentile(values, 50),
-        75: percentile(values, 75),
-        95: percentile(values, 95),
-        100: max(values),
-    }
-    for k, v in d.items():
-        print('%s: %d percentile: %f' % (label, k, v))
+## helper - at most max_points evenly spaced values of already sorted data,
+## always including the min and max
+def downsample(data, max_points):
+    if max_points < 0 or len(data) <= max_points: return data
+    return data[np.linspace(0, len(data) - 1, max_points).round().astype(int)]
+
+def percentiles(data, pcts):
+    ''' Return the given percentiles (0-100) of already sorted data, all at
+    once, interpolating linearly between values like scipy's
+    scoreatpercentile does. '''
+    idx = np.asarray(pcts, dtype=float) / 100 * (len(data) - 1)
+    lo = np.floor(idx).astype(int)
+    hi = np.ceil(idx).astype(int)
+    return data[lo] + (data[hi] - data[lo]) * (idx - lo)
+
+def percentile_type(s):
+    p = float(s)
+    if not 0 <= p <= 100:
+        raise ArgumentTypeError('must be from 0 to 100')
+    return p
+
+def print_percentiles(label, pcts, values):
+    for k, v in zip(pcts, values):
+        print('%s: %g percentile: %f' % (label, k, v))
+
+## per-input work, run in parallel and cached by plotdata.process_inputs()
+def compute_cdf(fname, max_points, pcts, use_cache):
+    values = get_sorted(plotdata.load(fname, 1, use_cache=use_cache)[:, 0])
+    x, y = getcdf(downsample(values, max_points))
+    return {'x': x, 'y': y, 'min': values[0], 'max': values[-1],
+        'percentiles': percentiles(values, pcts)}
+
+class KLL:
+    ''' Mergeable streaming quantile sketch (Karnin, Lang, Liberty 2016).
+
+    Keeps a stack of compactors. Level h holds values that each stand for 2**h
+    input values. Compacting a level sorts it and promotes every other value
+    in it (starting at a random offset) to the level above. Level 0 is
+    compacted when it holds as many values as the levels' capacities add up
+    to, then the lowest full level until the sketch fits again. The rank
+    error is about 1.65/k of the input size with high probability,
+    regardless of how many values are added; see :func:`KLL.k_for_error`. '''
+    MAGIC = b'KLL1'
+    C = 2 / 3
+
+    def __init__(self, k=200):
+        self.k = k
+        self.n = 0
+        self.min, self.max = float('inf'), float('-inf')
+        self.levels = [np.empty(0)]
+        self._update_capacities()
+
+    @staticmethod
+    def k_for_error(eps):
+        return max(8, int(np.ceil(1.65 / eps)))
+
+    def _update_capacities(self):
+        ''' Recompute the cached per-level capacities, which depend on k and
+        the number of levels, and the running size. Called whenever k or the
+        number of levels changes. '''
+        depth = len(self.levels)
+        self._capacities = [int(np.ceil(self.k * self.C ** (depth - h - 1)))
+            + 1 for h in range(depth)]
+        self._max_size = sum(self._capacities)
+        self._size = sum(len(l) for l in self.levels)
+
+    def _compact(self, h):
+        ''' Sort level h and promote every other value in it to level h+1 '''
+        if h + 1 == len(self.levels):
+            self.levels.append(np.empty(0))
+            self._update_capacities()
+        level = np.sort(self.levels[h])
+        # an odd value out stays behind at this level
+        end = len(level) - len(level) % 2
+        promoted = level[np.random.randint(2):end:2]
+        self.levels[h + 1] = np.concatenate((self.levels[h + 1], promoted))
+        self.levels[h] = level[end:]
+        self._size -= end - len(promoted)
+
+    def _compress(self):
+        self._compact(0)
+        while self._size >= self._max_size:
+            self._compact(next(h for h, level in enumerate(self.levels)
+                if len(level) >= self._capacities[h]))
+
+    def update(self, values):
+        ''' Add an array of values to the sketch. NaNs are ignored. '''
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if not len(values): return
+        self.n += len(values)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        i = 0
+        while i < len(values):
+            # Level 0 is a buffer that holds up to as many values as the rest
+            # of the sketch and is only compacted once it is full. Compacting
+            # it in a few big batches instead of many small ones is faster,
+            # and adds less error too.
+            chunk = values[i:i + self._max_size - len(self.levels[0])]
+            self.levels[0] = np.concatenate((self.levels[0], chunk))
+            self._size += len(chunk)
+            i += len(chunk)
+            if len(self.levels[0]) >= self._max_size: self._compress()
+
+    def merge(self, other):
+        ''' Add everything summarized by another sketch to this one '''
+        self.k = max(self.k, other.k)
+        self.n += other.n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for h, level in enumerate(other.levels):
+            self.levels[h] = np.concatenate((self.levels[h], level))
+        self._update_capacities()
+        self._compress()
+
+    def cdf(self):
+        ''' Return the sorted values held by the sketch and the estimated
+        cumulative fraction of the input at each '''
+        values = np.concatenate([np.asarray(l, dtype=float)
+            for l in self.levels])
+        weights = np.concatenate([np.full(len(l), 2.0 ** h)
+            for h, l in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        values, weights = values[order], weights[order]
+        frac = np.cumsum(weights)
+        return values, frac / frac[-1]
+
+    def percentiles(self, pcts):
+        ''' Estimate the given percentiles (0-100) of the input. 0 and 100
+        are exact. '''
+        values, frac = self.cdf()
+        idx = np.searchsorted(frac, np.asarray(pcts, dtype=float) / 100)
+        out = values[np.minimum(idx, len(values) - 1)]
+        out[np.asarray(pcts) <= 0] = self.min
+        out[np.asarray(pcts) >= 100] = self.max
+        return out
+
+    def save(self, fname):
+        with open(fname, 'wb') as fd:
+            fd.write(self.MAGIC)
+            fd.write(np.array([self.k, self.n, len(self.levels)],
+                dtype='<i8').tobytes())
+            fd.write(np.array([self.min, self.max], dtype='<f8').tobytes())
+            for level in self.levels:
+                fd.write(np.array([len(level)], dtype='<i8').tobytes())
+                fd.write(np.asarray(level, dtype='<f8').tobytes())
+
+    @staticmethod
+    def load(fname):
+        with open(fname, 'rb') as fd:
+            if fd.read(len(KLL.MAGIC)) != KLL.MAGIC:
+                raise ValueError('%s is not a KLL sketch file' % (fname,))
+            k, n, num_levels = np.frombuffer(fd.read(24), dtype='<i8')
+            sk = KLL(int(k))
+            sk.n = int(n)
+            sk.min, sk.max = np.frombuffer(fd.read(16), dtype='<f8')
+            sk.levels = []
+            for _ in range(num_levels):
+                size = int(np.frombuffer(fd.read(8), dtype='<i8')[0])
+                sk.levels.append(
+                    np.frombuffer(fd.read(8 * size), dtype='<f8').astype(float))
+            sk._update_capacities()
+        return sk
+
+## helper - feed values from a file into a sketch a block at a time, without
+## ever holding more than one block in memory
+def sketch_fname(fname, sketch):
+    num_bad = 0
+    with (open(fname, 'rb') if fname != '-' else sys.stdin.buffer) as fd:
+        for values, bad in plotdata.iter_blocks(fd, 1):
+            sketch.update(values[:, 0])
+            num_bad += bad
+    if num_bad: print('ignored %d bad lines in %s' % (
+        num_bad, 'stdin' if fname == '-' else fname))
+    return sketch
+
+def main_sketch(args, pdf):
+    k = KLL.k_for_error(args.sketch_error)
+    # inputs sharing a label get merged into one sketch, so per-host or
+    # per-hour sketches can be combined into one line
+    sketches = {}
+    for fname, label in args.input or [('-', 'stdin')]:
+        if fname.endswith('.kll'):
+            sk = KLL.load(fname)
+        else:
+            sk = sketch_fname(fname, KLL(k))
+        if args.save_sketch and not fname.endswith('.kll'):
+            sk.save(('stdin' if fname == '-' else fname) + '.kll')
+        if label in sketches: sketches[label].merge(sk)
+        else: sketches[label] = sk
+    plt.figure()
+    all_min, all_max = None, None
+    for label, sk in sketches.items():
+        plt.plot(*getcdf(*sk.cdf()), label=label)
+        print_percentiles(label, args.percentiles,
+            sk.percentiles(args.percentiles))
+        if all_min == None or sk.min < all_min: all_min = sk.min
+        if all_max == None or sk.max > all_max: all_max = sk.max
+    plt.xlim(xmin=all_min, xmax=all_max)
+    if args.input: plt.legend(loc='lower right')
+    plt.ylim(ymin=0, ymax=1)
+    if args.label: plt.xlabel(args.label)
+    if args.title: plt.title(args.title)
+    plt.ylabel('CDF')
+    pdf.savefig()
 
 def main(args, pdf):
+    inputs = args.input or [('-', 'stdin')]
+    results = plotdata.process_inputs(compute_cdf, [f for f, _ in inputs], {
+        'max_points': args.max_points, 'pcts': args.percentiles,
+        'use_cache': not args.no_cache,
+    }, jobs=args.jobs, cache_dir=None if args.no_cache else args.cache_dir)
     plt.figure()
-    if not args.input:
-        values = get_all_values_from_fd(sys.stdin)
-        if args.max_points >= 0 and len(values) > args.max_points:
-            values = random.sample(values, args.max_points)
-        plt.plot(*getcdf(values))
-        print_percentiles('stdin', values)
-        plt.xlim(xmin=min(values), xmax=max(values))
-    else:
-        all_min, all_max = None, None
-        for fname, label in args.input:
-            with open(fname, 'rt') as fd:
-                values = get_all_values_from_fd(fd)
-            if args.max_points >= 0 and len(values) > args.max_points:
-                values = random.sample(values, args.max_points)
-            this_min, this_max = min(values), max(values)
-            if all_min == None or this_min < all_min: all_min = this_min
-            if all_max == None or this_max > all_max: all_max = this_max
-            plt.plot(*getcdf(values), label=label)
-            print_percentiles(label, values)
-        plt.xlim(xmin=all_min, xmax=all_max)
-        plt.legend(loc='lower right')
+    all_min, all_max = None, None
+    for (fname, label), r in zip(inputs, results):
+        if all_min == None or r['min'] < all_min: all_min = r['min']
+        if all_max == None or r['max'] > all_max: all_max = r['max']
+        plt.plot(r['x'], r['y'], label=label if args.input else None)
+        print_percentiles(label, args.percentiles, r['percentiles'])
+    plt.xlim(xmin=all_min, xmax=all_max)
+    if args.input: plt.legend(loc='lower right')
     plt.ylim(ymin=0, ymax=1)
     if args.label: plt.xlabel(args.label)
     if args.title: plt.title(args.title)
@@ -100,7 +280,34 @@ if __name__=='__main__':
     parser.add_argument('-t', '--title', type=str,
         help='What to title the plot in the PDF')
     parser.add_argument('--max-points', default=10000, type=int,
-        help='Maximum number of points on a line. Negative means infinite')
+        help='Maximum number of points on a line. Negative means infinite. '
+        'Percentiles are always computed from all the values')
+    parser.add_argument('-p', '--percentiles', type=percentile_type, nargs='+',
+        default=[0, 5, 25, 50, 75, 95, 100], metavar='P',
+        help='Which percentiles (0-100) of each input to print')
+    parser.add_argument('-j', '--jobs', type=int,
+        help='Number of processes to read inputs with. Default is one per '
+        'CPU')
+    parser.add_argument('--cache-dir', default=plotdata.DEFAULT_CACHE_DIR,
+        help='Where to cache the per-input results, keyed on the input\'s '
+        'contents and the options that affect them')
+    parser.add_argument('--no-cache', action='store_true',
+        help='Do not read or write any caches: neither --cache-dir nor the '
+        '.npy files kept next to input files')
+    parser.add_argument('--sketch', action='store_true',
+        help='Summarize each input with a fixed-size quantile sketch instead '
+        'of keeping every value in memory. Inputs whose FNAME ends in .kll '
+        'are previously saved sketches, and inputs that share a LABEL are '
+        'merged into one line')
+    parser.add_argument('--sketch-error', type=float, default=0.01,
+        help='With --sketch, the target rank error of the sketches, as a '
+        'fraction of the number of values')
+    parser.add_argument('--save-sketch', action='store_true',
+        help='With --sketch, save the sketch of each input FNAME to '
+        'FNAME.kll (stdin.kll for stdin) for merging later')
     args = parser.parse_args()
+    if not args.sketch and any(f.endswith('.kll') for f, _ in args.input or []):
+        parser.error('Reading .kll sketch files requires --sketch')
     with PdfPages(args.output) as pdf:
+        if args.sketch: exit(main_sketch(args, pdf))
         exit(main(args, pdf))
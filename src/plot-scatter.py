@@ -1,63 +1,152 @@
 #!/usr/bin/env python3
 
-import sys
-import random
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 import matplotlib; matplotlib.use('Agg')  # noqa; for systems without X11
 from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.colors import LogNorm
+from matplotlib.patches import Patch
 import pylab as plt
+import numpy as np
+import plotdata
 
 plt.rcParams.update({
     'axes.grid': True,
 })
 
+# colormaps for the layers of --density --overlay, in order
+DENSITY_CMAPS = ['Blues', 'Reds', 'Greens', 'Purples', 'Oranges', 'Greys']
 
-def get_all_values_from_fd(fd):
-    values = []
-    for line in fd:
-        try:
-            x, y = line.strip().split()
-            values.append((float(x), float(y)))
-        except ValueError:
-            print('ignoring', line)
-            continue
-    return values
+
+def sample(values, max_points):
+    if max_points < 0 or len(values) <= max_points:
+        return values
+    return values[np.random.choice(len(values), max_points, replace=False)]
+
+
+# Per-input work, run in parallel and cached by plotdata.process_inputs()
+
+def compute_scatter(fname, max_points, use_cache):
+    values = sample(plotdata.load(fname, 2, use_cache=use_cache), max_points)
+    return {'x': values[:, 0], 'y': values[:, 1], 'extents': extents(values)}
+
+
+def compute_extents(fname, use_cache):
+    return {'extents': extents(plotdata.load(fname, 2, use_cache=use_cache))}
+
+
+def compute_hist2d(fname, bins, bin_range, use_cache):
+    return hist2d(plotdata.load(fname, 2, use_cache=use_cache), bins,
+                  bin_range)
+
+
+def hist2d(values, bins, bin_range):
+    counts, x_edges, y_edges = np.histogram2d(
+        values[:, 0], values[:, 1], bins=bins, range=bin_range)
+    return {'counts': counts, 'x_edges': x_edges, 'y_edges': y_edges}
+
+
+def extents(values):
+    ''' Return min x, min y, max x, max y '''
+    return np.concatenate((values.min(axis=0), values.max(axis=0)))
+
+
+def all_extents(results):
+    min_x, min_y, _, _ = np.min([r['extents'] for r in results], axis=0)
+    _, _, max_x, max_y = np.max([r['extents'] for r in results], axis=0)
+    return float(min_x), float(min_y), float(max_x), float(max_y)
+
+
+def main_density(args, pdf):
+    ''' Instead of drawing a marker per point, count the points in a 2-D grid
+    of bins and draw the counts as a rasterized image. The PDF's size and
+    rendering time then depend on the number of bins, not points. '''
+    inputs = args.input or [('-', 'stdin')]
+    fnames = [f for f, _ in inputs]
+    use_cache = not args.no_cache
+    cache_dir = None if args.no_cache else args.cache_dir
+    # stdin can only be read once, so load it here and work on that array.
+    # Only real files go through the cached process_inputs().
+    piped = {f: plotdata.load(f, 2) for f in fnames if f == '-'}
+    files = [f for f in fnames if f not in piped]
+
+    def per_input(compute, opts, from_values):
+        results = iter(plotdata.process_inputs(
+            compute, files, opts, jobs=args.jobs, cache_dir=cache_dir))
+        return [from_values(piped[f]) if f in piped else next(results)
+                for f in fnames]
+
+    # every layer shares the same bins
+    min_x, min_y, max_x, max_y = all_extents(per_input(
+        compute_extents, {'use_cache': use_cache},
+        lambda values: {'extents': extents(values)}))
+    if args.density == 'hexbin':
+        # matplotlib needs the points themselves, so there is nothing worth
+        # caching beyond the .npy files, and sending them back from a process
+        # pool would cost more than loading them here
+        layers = [piped[f] if f in piped
+                  else plotdata.load(f, 2, use_cache=use_cache)
+                  for f in fnames]
+        if not args.overlay:
+            layers = [np.concatenate(layers)]
+    else:
+        bin_range = ((min_x, max_x), (min_y, max_y))
+        layers = per_input(compute_hist2d, {
+            'bins': args.bins, 'use_cache': use_cache, 'bin_range': bin_range,
+        }, lambda values: hist2d(values, args.bins, bin_range))
+        if not args.overlay:
+            layers = [dict(layers[0],
+                           counts=sum(r['counts'] for r in layers))]
+    plt.figure()
+    handles = []
+    for i, layer in enumerate(layers):
+        cmap = DENSITY_CMAPS[i % len(DENSITY_CMAPS)] if args.overlay \
+            else 'viridis'
+        alpha = 0.6 if args.overlay else None
+        if args.density == 'hexbin':
+            img = plt.hexbin(
+                layer[:, 0], layer[:, 1], gridsize=args.bins,
+                extent=(min_x, max_x, min_y, max_y),
+                bins='log' if args.log else None, mincnt=1, cmap=cmap,
+                alpha=alpha, rasterized=True)
+        else:
+            # leave empty bins transparent so overlaid layers show through
+            counts = np.ma.masked_equal(layer['counts'], 0)
+            img = plt.pcolormesh(
+                layer['x_edges'], layer['y_edges'], counts.T, cmap=cmap,
+                alpha=alpha, norm=LogNorm() if args.log else None,
+                rasterized=True)
+        if args.overlay:
+            handles.append(Patch(color=img.cmap(0.7), label=inputs[i][1]))
+        else:
+            plt.colorbar(img, label='Points per bin')
+    plt.xlim(xmin=min_x, xmax=max_x)
+    plt.ylim(ymin=min_y, ymax=max_y)
+    if handles:
+        plt.legend(handles=handles, loc='lower right')
+    if args.xlabel:
+        plt.xlabel(args.xlabel)
+    if args.ylabel:
+        plt.ylabel(args.ylabel)
+    if args.title:
+        plt.title(args.title)
+    pdf.savefig(dpi=args.dpi)
 
 
 def main(args, pdf):
+    inputs = args.input or [('-', 'stdin')]
+    results = plotdata.process_inputs(
+        compute_scatter, [f for f, _ in inputs], {
+            'max_points': args.max_points, 'use_cache': not args.no_cache,
+        }, jobs=args.jobs,
+        cache_dir=None if args.no_cache else args.cache_dir)
     plt.figure()
-    if not args.input:
-        values = get_all_values_from_fd(sys.stdin)
-        if args.max_points >= 0 and len(values) > args.max_points:
-            values = random.sample(values, args.max_points)
-        x = [v[0] for v in values]
-        y = [v[1] for v in values]
-        plt.scatter(x, y, s=args.size)
-        plt.xlim(xmin=min(x), xmax=max(x))
-        plt.ylim(ymin=min(y), ymax=max(y))
-    else:
-        all_min_x, all_max_x = None, None
-        all_min_y, all_max_y = None, None
-        for fname, label in args.input:
-            with open(fname, 'rt') as fd:
-                values = get_all_values_from_fd(fd)
-            if args.max_points >= 0 and len(values) > args.max_points:
-                values = random.sample(values, args.max_points)
-            x = [v[0] for v in values]
-            y = [v[1] for v in values]
-            this_min_x, this_max_x = min(x), max(x)
-            this_min_y, this_max_y = min(y), max(y)
-            if all_min_x is None or this_min_x < all_min_x:
-                all_min_x = this_min_x
-            if all_max_x is None or this_max_x > all_max_x:
-                all_max_x = this_max_x
-            if all_min_y is None or this_min_y < all_min_y:
-                all_min_y = this_min_y
-            if all_max_y is None or this_max_y > all_max_y:
-                all_max_y = this_max_y
-            plt.scatter(x, y, s=args.size, label=label)
-        plt.xlim(xmin=all_min_x, xmax=all_max_x)
-        plt.ylim(ymin=all_min_y, ymax=all_max_y)
+    for (fname, label), r in zip(inputs, results):
+        plt.scatter(r['x'], r['y'], s=args.size,
+                    label=label if args.input else None)
+    min_x, min_y, max_x, max_y = all_extents(results)
+    plt.xlim(xmin=min_x, xmax=max_x)
+    plt.ylim(ymin=min_y, ymax=max_y)
+    if args.input:
         plt.legend(loc='lower right')
     if args.xlabel:
         plt.xlabel(args.xlabel)
@@ -92,6 +181,34 @@ if __name__ == '__main__':
                         'means infinite')
     parser.add_argument('-s', '--size', type=float, default=5,
                         help='Size of scatter plot points')
+    parser.add_argument('--density', choices=('hist2d', 'hexbin'),
+                        help='Instead of a marker per point, draw how many '
+                        'points fall in each bin of a 2-D histogram or '
+                        'hexagonal grid, as a rasterized image. All points '
+                        'are used; --max-points is ignored')
+    parser.add_argument('--bins', type=int, default=200,
+                        help='With --density, number of bins along each axis')
+    parser.add_argument('--log', action='store_true',
+                        help='With --density, use a log color scale')
+    parser.add_argument('--overlay', action='store_true',
+                        help='With --density, draw a separately colored layer '
+                        'for each input instead of combining all inputs '
+                        'into one')
+    parser.add_argument('--dpi', type=int, default=300,
+                        help='Resolution of rasterized --density layers')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='Number of processes to read inputs with. '
+                        'Default is one per CPU')
+    parser.add_argument('--cache-dir', default=plotdata.DEFAULT_CACHE_DIR,
+                        help='Where to cache the per-input results, keyed on '
+                        'the input\'s contents and the options that affect '
+                        'them')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Do not read or write any caches: neither '
+                        '--cache-dir nor the .npy files kept next to input '
+                        'files')
     args = parser.parse_args()
     with PdfPages(args.output) as pdf:
+        if args.density:
+            exit(main_density(args, pdf))
         exit(main(args, pdf))
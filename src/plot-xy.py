@@ -1,66 +1,154 @@
 #!/usr/bin/env python3
 
-import sys
-import random
+import os
+import tempfile
+import time
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 import matplotlib; matplotlib.use('Agg')  # noqa; for systems without X11
 from matplotlib.backends.backend_pdf import PdfPages
 import pylab as plt
+import numpy as np
+import plotdata
 
 plt.rcParams.update({
     'axes.grid': True,
 })
 
 colors = "krbgcmy"
-color_idx = 0
 
-def get_all_values_from_fd(fd):
-    values = []
-    for line in fd:
-        try:
-            x, y = line.strip().split()
-            values.append((float(x), float(y)))
-        except ValueError:
-            print('ignoring', line)
-            continue
-    return values
+def downsample_random(values, max_points):
+    ''' Keep a random sample of max_points points, in their original order '''
+    keep = np.random.choice(len(values), max_points, replace=False)
+    keep.sort()
+    return values[keep]
+
+
+def downsample_minmax(values, max_points):
+    ''' Split the (x-sorted) points into max_points/2 equally sized buckets
+    and keep the points with the min and max y in each, plus the first and
+    last points. Fully vectorized, and never loses a spike. '''
+    n = len(values)
+    num_buckets = max(1, (max_points - 2) // 2)
+    edges = np.linspace(0, n, num_buckets + 1).astype(int)
+    bucket = np.repeat(np.arange(num_buckets), np.diff(edges))
+    # sort by bucket, then by y within each bucket. The first and last point
+    # of each bucket's run are then its min and max.
+    order = np.lexsort((values[:, 1], bucket))
+    keep = np.concatenate((
+        [0, n - 1], order[edges[:-1]], order[edges[1:] - 1]))
+    return values[np.unique(keep)]
+
+
+def downsample_lttb(values, max_points):
+    ''' Largest-Triangle-Three-Buckets (Steinarsson, 2013). Keep the first
+    and last of the (x-sorted) points, and from each of max_points-2 equally
+    sized buckets in between, the point that makes the largest triangle with
+    the point kept from the previous bucket and the average of the next
+    bucket. Keeps the visual shape of the line, spikes included. '''
+    n = len(values)
+    if max_points < 3:
+        return values[[0, n - 1]]
+    x, y = values[:, 0], values[:, 1]
+    edges = np.linspace(1, n - 1, max_points - 1).astype(int)
+    # averages of every bucket, all at once, with the last point appended as
+    # the "next bucket" of the last bucket
+    counts = np.diff(edges)
+    avg_x = np.append(np.add.reduceat(x[1:-1], edges[:-1] - 1) / counts, x[-1])
+    avg_y = np.append(np.add.reduceat(y[1:-1], edges[:-1] - 1) / counts, y[-1])
+    keep = np.empty(max_points, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(max_points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # twice the triangle areas for every candidate in the bucket
+        area = np.abs(
+            (x[a] - avg_x[i + 1]) * (y[lo:hi] - y[a]) -
+            (x[a] - x[lo:hi]) * (avg_y[i + 1] - y[a]))
+        a = lo + int(area.argmax())
+        keep[i + 1] = a
+    return values[keep]
+
+
+DOWNSAMPLERS = {
+    'lttb': downsample_lttb,
+    'minmax': downsample_minmax,
+    'random': downsample_random,
+}
+
+
+def downsample(values, max_points, method):
+    ''' Sort the points by x and reduce them to about max_points using the
+    named method. Negative max_points means keep everything. '''
+    if max_points < 0 or len(values) <= max_points:
+        return values
+    values = values[np.argsort(values[:, 0], kind='stable')]
+    return DOWNSAMPLERS[method](values, max_points)
+
+
+def benchmark(label, values, args):
+    ''' Print how long the given series takes to render to a PDF, and how big
+    the PDF is, before and after downsampling. '''
+    start = time.time()
+    small = downsample(values, args.max_points, args.downsample)
+    print('%s: %s downsampling %d -> %d points took %0.3f seconds' % (
+        label, args.downsample, len(values), len(small), time.time() - start))
+    for name, pts in (('raw', values), (args.downsample, small)):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fname = os.path.join(tmp_dir, 'bench.pdf')
+            start = time.time()
+            with PdfPages(fname) as bench_pdf:
+                plt.figure()
+                plt.plot(pts[:, 0], pts[:, 1])
+                bench_pdf.savefig()
+                plt.close()
+            duration = time.time() - start
+            size = os.path.getsize(fname)
+        print('%s: %s: %d points rendered in %0.3f seconds, %d byte PDF' % (
+            label, name, len(pts), duration, size))
+
+
+def summarize_xy(values, max_points, method):
+    # extents come from all the points, not just the ones drawn
+    extents = np.concatenate((values.min(axis=0), values.max(axis=0)))
+    values = downsample(values, max_points, method)
+    return {'x': values[:, 0], 'y': values[:, 1], 'extents': extents}
+
+
+def compute_xy(fname, max_points, method, use_cache):
+    ''' Per-input work, run in parallel and cached by
+    plotdata.process_inputs() '''
+    return summarize_xy(
+        plotdata.load(fname, 2, use_cache=use_cache), max_points, method)
 
 
 def main(args, pdf):
-    plt.figure()
+    inputs = args.input or [('-', 'stdin')]
     if not args.input:
-        values = get_all_values_from_fd(sys.stdin)
-        if args.max_points >= 0 and len(values) > args.max_points:
-            values = random.sample(values, args.max_points)
-        x = [v[0] for v in values]
-        y = [v[1] for v in values]
-        plt.plot(x, y, c=colors[color_idx])
-        color_idx += 1
-        plt.xlim(xmin=min(x), xmax=max(x))
-        plt.ylim(ymin=min(y), ymax=max(y))
+        # stdin can only be read once
+        values = plotdata.load('-', 2)
+        if args.benchmark:
+            benchmark('stdin', values, args)
+        results = [summarize_xy(values, args.max_points, args.downsample)]
     else:
-        all_min_x, all_max_x = None, None
-        all_min_y, all_max_y = None, None
-        for fname, label in args.input:
-            with open(fname, 'rt') as fd:
-                values = get_all_values_from_fd(fd)
-            if args.max_points >= 0 and len(values) > args.max_points:
-                values = random.sample(values, args.max_points)
-            x = [v[0] for v in values]
-            y = [v[1] for v in values]
-            this_min_x, this_max_x = min(x), max(x)
-            this_min_y, this_max_y = min(y), max(y)
-            if all_min_x is None or this_min_x < all_min_x:
-                all_min_x = this_min_x
-            if all_max_x is None or this_max_x > all_max_x:
-                all_max_x = this_max_x
-            if all_min_y is None or this_min_y < all_min_y:
-                all_min_y = this_min_y
-            if all_max_y is None or this_max_y > all_max_y:
-                all_max_y = this_max_y
-            plt.plot(x, y, label=label, c=colors[color_idx])
-        plt.xlim(xmin=all_min_x, xmax=all_max_x)
-        plt.ylim(ymin=all_min_y, ymax=all_max_y)
+        if args.benchmark:
+            for fname, label in inputs:
+                benchmark(label, plotdata.load(
+                    fname, 2, use_cache=not args.no_cache), args)
+        results = plotdata.process_inputs(
+            compute_xy, [f for f, _ in inputs], {
+                'max_points': args.max_points, 'method': args.downsample,
+                'use_cache': not args.no_cache,
+            }, jobs=args.jobs,
+            cache_dir=None if args.no_cache else args.cache_dir)
+    plt.figure()
+    for i, ((fname, label), r) in enumerate(zip(inputs, results)):
+        plt.plot(r['x'], r['y'], label=label if args.input else None,
+                 c=colors[i % len(colors)])
+    min_x, min_y, _, _ = np.min([r['extents'] for r in results], axis=0)
+    _, _, max_x, max_y = np.max([r['extents'] for r in results], axis=0)
+    plt.xlim(xmin=min_x, xmax=max_x)
+    plt.ylim(ymin=min_y, ymax=max_y)
+    if args.input:
         plt.legend(loc='lower right')
     if args.xlabel:
         plt.xlabel(args.xlabel)
@@ -93,6 +181,27 @@ if __name__ == '__main__':
     parser.add_argument('--max-points', default=10000, type=int,
                         help='Maximum number of points on a line. Negative '
                         'means infinite')
+    parser.add_argument('--downsample', choices=sorted(DOWNSAMPLERS),
+                        default='lttb',
+                        help='How to reduce a line to --max-points points. '
+                        'lttb keeps the visual shape, minmax keeps the min '
+                        'and max of each bucket, random keeps a random '
+                        'sample. Points are sorted by x first')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='For each line, also print how long it takes '
+                        'to render and how big its PDF is, with and without '
+                        'downsampling')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='Number of processes to read inputs with. '
+                        'Default is one per CPU')
+    parser.add_argument('--cache-dir', default=plotdata.DEFAULT_CACHE_DIR,
+                        help='Where to cache the per-input results, keyed on '
+                        'the input\'s contents and the options that affect '
+                        'them')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Do not read or write any caches: neither '
+                        '--cache-dir nor the .npy files kept next to input '
+                        'files')
     args = parser.parse_args()
     with PdfPages(args.output) as pdf:
         exit(main(args, pdf))
@@ -0,0 +1,243 @@
+''' Fast loading of the whitespace- or comma-separated numeric text files
+that plot-cdf.py, plot-xy.py, and plot-scatter.py plot.
+
+Files are parsed in large blocks straight into NumPy arrays. Lines that can't
+be parsed are counted instead of printed one at a time. Blank lines and lines
+starting with '#' are skipped. The parsed array is saved next to the input as
+a sidecar .npy file whose name includes the input's size and mtime, so plotting
+the same file again (say, with a new title) skips parsing entirely.
+
+On top of that, :func:`process_inputs` runs the per-input work of a plot
+script (parse, sort, downsample, ...) for all of its inputs in parallel in a
+process pool, and caches the results keyed by a hash of each input's contents
+and the options that affect the result. Regenerating a plot after one of its
+inputs changed only redoes the work for that input. '''
+import glob
+import hashlib
+import io
+import os
+import sys
+import warnings
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+BLOCK_SIZE = 16 * 1024 * 1024
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'python-snippits', 'plot')
+# most results to keep in a cache dir. The least recently used are removed.
+MAX_CACHE_ENTRIES = 1000
+# Part of every cache key. Bump it to invalidate all cached results, should
+# they ever depend on something other than the code in the plot script and
+# this module, which is already hashed into the key.
+CACHE_VERSION = 1
+
+
+def _parse_lines(block, ncols):
+    ''' Slow path: parse a block one line at a time, counting bad lines '''
+    values, num_bad = [], 0
+    for line in block.split(b'\n'):
+        words = line.split()
+        if not words or words[0].startswith(b'#'):
+            continue
+        if len(words) != ncols:
+            num_bad += 1
+            continue
+        try:
+            values.append([float(w) for w in words])
+        except ValueError:
+            num_bad += 1
+    return np.array(values, dtype=float).reshape(-1, ncols), num_bad
+
+
+def parse_block(block, ncols):
+    ''' Parse a bytes object holding whole lines of ``ncols`` numbers each,
+    separated by whitespace or commas. Returns an array of shape (N, ncols)
+    and the number of bad lines. '''
+    if b',' in block:
+        block = block.replace(b',', b' ')
+    try:
+        with warnings.catch_warnings():
+            # loadtxt warns about blocks with no data lines in them
+            warnings.simplefilter('ignore', UserWarning)
+            values = np.loadtxt(io.BytesIO(block), dtype=float, ndmin=2)
+    except ValueError:
+        return _parse_lines(block, ncols)
+    if not values.size:
+        return values.reshape(-1, ncols), 0
+    if values.shape[1] != ncols:
+        return _parse_lines(block, ncols)
+    return values, 0
+
+
+def iter_blocks(fd, ncols, block_size=BLOCK_SIZE):
+    ''' Read the given binary file-like object a block at a time and yield an
+    array of shape (N, ncols) and the number of bad lines for each block. '''
+    leftover = b''
+    while True:
+        data = fd.read(block_size)
+        if not data:
+            break
+        data = leftover + data
+        end = data.rfind(b'\n') + 1
+        if not end:
+            leftover = data
+            continue
+        leftover = data[end:]
+        yield parse_block(data[:end], ncols)
+    if leftover:
+        yield parse_block(leftover, ncols)
+
+
+def read_fd(fd, ncols):
+    ''' Read all the values in the given binary file-like object. Returns an
+    array of shape (N, ncols) and the number of bad lines. '''
+    arrays, num_bad = [], 0
+    for values, bad in iter_blocks(fd, ncols):
+        arrays.append(values)
+        num_bad += bad
+    if not arrays:
+        return np.empty((0, ncols)), num_bad
+    return np.concatenate(arrays), num_bad
+
+
+def cache_fname(fname, ncols):
+    ''' Name of the sidecar cache file for the given input file as it is right
+    now. Changing the file changes the name, which invalidates the cache. '''
+    st = os.stat(fname)
+    return '%s.%dc.%d-%d.npy' % (fname, ncols, st.st_size, st.st_mtime_ns)
+
+
+def load(fname, ncols, use_cache=True):
+    ''' Return an array of shape (N, ncols) with the values in the given file,
+    or in stdin if ``fname`` is '-'. Prints how many lines were ignored, if
+    any. Uses and updates a sidecar cache file if ``use_cache``. '''
+    if fname == '-':
+        values, num_bad = read_fd(sys.stdin.buffer, ncols)
+    else:
+        cache = cache_fname(fname, ncols) if use_cache else None
+        if cache and os.path.exists(cache):
+            return np.load(cache)
+        with open(fname, 'rb') as fd:
+            values, num_bad = read_fd(fd, ncols)
+        if cache:
+            _write_cache(fname, ncols, cache, values)
+    if num_bad:
+        print('ignored %d bad lines in %s' % (
+            num_bad, 'stdin' if fname == '-' else fname))
+    return values
+
+
+def _write_cache(fname, ncols, cache, values):
+    # remove caches of older versions of this file
+    for old in glob.glob('%s.%dc.*-*.npy' % (glob.escape(fname), ncols)):
+        try:
+            os.unlink(old)
+        except OSError:
+            pass
+    # write to a temporary name first so nobody ever loads half a cache
+    tmp = '%s.%d.tmp' % (cache, os.getpid())
+    try:
+        with open(tmp, 'wb') as fd:
+            np.save(fd, values)
+        os.replace(tmp, cache)
+    except OSError as e:
+        print('WARN: unable to write cache', cache, e)
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+def hash_file(fname):
+    ''' Return a hex digest of the contents of the given file '''
+    h = hashlib.blake2b(digest_size=20)
+    with open(fname, 'rb') as fd:
+        for block in iter(lambda: fd.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _prune_cache(cache_dir):
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.npz'):
+            continue
+        try:
+            entries.append(
+                (os.stat(os.path.join(cache_dir, name)).st_mtime, name))
+        except OSError:
+            pass
+    entries.sort()
+    for _, name in entries[:-MAX_CACHE_ENTRIES]:
+        try:
+            os.unlink(os.path.join(cache_dir, name))
+        except OSError:
+            pass
+
+
+def code_hash(compute):
+    ''' Return a hex digest of the source of the module that defines
+    ``compute`` and of this module, so that cached results are recomputed
+    whenever the code that made them (including any helper it calls in those
+    files) changes. '''
+    h = hashlib.blake2b(digest_size=20)
+    module = sys.modules.get(compute.__module__)
+    for fname in sorted({getattr(module, '__file__', None), __file__} -
+                        {None}):
+        with open(fname, 'rb') as fd:
+            h.update(fd.read())
+    return h.hexdigest()
+
+
+def _run(job):
+    ''' Process pool entry point: call ``compute(fname, **opts)``, or return
+    its result from the cache in ``cache_dir`` if it's there. '''
+    compute, fname, opts, cache_dir, code = job
+    if fname == '-' or cache_dir is None:
+        return compute(fname, **opts)
+    key = hashlib.blake2b(repr((
+        CACHE_VERSION, code, hash_file(fname), compute.__name__,
+        sorted(opts.items()),
+    )).encode('utf-8'), digest_size=20).hexdigest()
+    cache = os.path.join(cache_dir, key + '.npz')
+    try:
+        with np.load(cache) as npz:
+            result = {k: npz[k] for k in npz.files}
+        # mark as recently used
+        os.utime(cache)
+        return result
+    except (OSError, ValueError, zipfile.BadZipFile):
+        # missing, or unreadable and about to be replaced
+        pass
+    result = compute(fname, **opts)
+    tmp = '%s.%d.tmp.npz' % (cache[:-4], os.getpid())
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(tmp, **result)
+        os.replace(tmp, cache)
+        _prune_cache(cache_dir)
+    except OSError as e:
+        print('WARN: unable to write cache', cache, e)
+    return result
+
+
+def process_inputs(compute, fnames, opts, jobs=None, cache_dir=None):
+    ''' Return the list of ``compute(fname, **opts)`` for each of the given
+    file names, in order. ``compute`` must be a top-level function returning
+    a dict of NumPy arrays (or things np.savez can turn into arrays), and all
+    of its inputs must be in ``fname`` and ``opts``.
+
+    The calls are spread over up to ``jobs`` processes (default: one per CPU).
+    If ``cache_dir`` is given, results are cached there, keyed by a hash of the
+    file's contents, the function's name, ``opts``, and the source of the
+    function's module and this one (see :func:`code_hash`). The file name '-'
+    (stdin) is always processed in this process and never cached. '''
+    code = code_hash(compute) if cache_dir is not None else None
+    work = [(compute, fname, opts, cache_dir, code) for fname in fnames]
+    if len(work) < 2 or jobs == 1 or '-' in fnames:
+        return [_run(w) for w in work]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(_run, work))
@@ -1,12 +1,1073 @@
 #!/usr/bin/env python3
+'''
+Serve a directory over HTTP, like python3 -m http.server, but able to keep up
+with many clients at once.
+
+Each connection is handled by one of --workers threads, so a slow client only
+ties up its own worker, and file bodies are sent with sendfile(2) straight
+from the page cache to the socket without being copied through Python.
+--workers 0 runs the plain single-threaded http.server instead. Run with
+--benchmark to compare the two on this machine.
+
+Files are served over persistent HTTP/1.1 connections, which are closed after
+--idle-timeout seconds without a request. Idle connections wait in a selector
+rather than on a worker, so they don't keep new clients waiting. Range
+requests (including multiple ranges) let interrupted downloads resume, and
+ETag and Last-Modified let clients revalidate what they have with
+If-None-Match, If-Modified-Since, and If-Range. Run with --self-test to check
+all that against a local client.
+
+Small files are kept in an LRU cache in memory, along with gzipped copies of
+the compressible ones for clients that accept gzip, so hot files aren't read
+from disk or compressed again on every request. GET /.cache-stats for the
+cache's hit and miss counts, to help choose --cache-size.
+
+Directory listings are read with os.scandir, sorted once, and kept until the
+directory changes, so listing a directory of 100k files again takes
+milliseconds. They are streamed out a piece at a time, and can be paged with
+?offset=N&limit=M and fetched as JSON with ?format=json.
+'''
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
-import os, http.server
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesParser
+from email.utils import parsedate_to_datetime
+import datetime
+import gzip
+import html
+import http.client
+import http.server
+import io
+import json
+import os
+import selectors
+import socket
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+# Files served by --benchmark: a small one to count requests per second, and a
+# large one to measure throughput
+BENCHMARK_FILES = [('small', 4 * 1024), ('large', 64 * 1024 * 1024)]
+# Most ranges to honor in one request. Requests with more get the whole file.
+MAX_RANGES = 64
+BOUNDARY = 'simple-http-server-byteranges'
+# Content types worth gzipping. Anything starting with one of these.
+COMPRESSIBLE_TYPES = (
+    'text/', 'application/json', 'application/javascript', 'application/xml',
+    'application/x-sh', 'image/svg+xml')
+STATS_PATH = '/.cache-stats'
+# Directory entries to render into each chunk of a streamed listing
+LISTING_CHUNK = 1000
+# Number of files in the directory --benchmark lists
+BENCHMARK_LISTING_SIZE = 100 * 1000
+
+
+class ContentCache:
+    ''' An LRU cache of the contents of small files, and of gzipped copies of
+    them, keyed on path, mtime, and size so a changed file is never served
+    stale. Holds at most max_entries entries and max_bytes bytes, and only
+    files of at most max_file_size bytes. Safe to use from many threads. '''
+    def __init__(self, max_bytes, max_entries, max_file_size):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.max_file_size = min(max_file_size, max_bytes)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.gzip_hits = self.gzip_misses = 0
+        self.evictions = 0
+
+    def _get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+            if key[-1] == 'gzip':
+                if data is None:
+                    self.gzip_misses += 1
+                else:
+                    self.gzip_hits += 1
+            elif data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return data
+
+    def _put(self, key, data):
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes or \
+                    len(self.entries) > self.max_entries:
+                _, old = self.entries.popitem(last=False)
+                self.size -= len(old)
+                self.evictions += 1
+
+    def get(self, path, st, use_gzip):
+        ''' Return the contents of the file at path, whose os.stat() is st,
+        and their encoding: 'gzip' if use_gzip and it makes them smaller, else
+        None. Reads the file and compresses it if needed. Returns None if the
+        file is too big to cache, or changed while being read. '''
+        if st.st_size > self.max_file_size:
+            return None
+        key = (path, st.st_mtime_ns, st.st_size, None)
+        data = self._get(key)
+        if data is None:
+            with open(path, 'rb') as fd:
+                data = fd.read()
+            if len(data) != st.st_size:
+                return None
+            self._put(key, data)
+        if not use_gzip:
+            return data, None
+        gz_key = key[:-1] + ('gzip',)
+        gz = self._get(gz_key)
+        if gz is None:
+            gz = gzip.compress(data, compresslevel=6, mtime=0)
+            # remember that it isn't worth it, so we don't try again
+            if len(gz) >= len(data):
+                gz = b''
+            self._put(gz_key, gz)
+        return (gz, 'gzip') if gz else (data, None)
+
+    def counters(self):
+        """ Return a dict with the number of hits and misses for plain
+        contents ('hits', 'misses') and for their gzipped copies ('gzip_hits',
+        'gzip_misses'), the number of entries evicted to make room
+        ('evictions'), and how much is in the cache now ('entries', 'bytes'
+        and their limits) """
+        with self.lock:
+            return {
+                'hits': self.hits, 'misses': self.misses,
+                'gzip_hits': self.gzip_hits, 'gzip_misses': self.gzip_misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries), 'max_entries': self.max_entries,
+                'bytes': self.size, 'max_bytes': self.max_bytes}
+
+
+def parse_ranges(header, size):
+    ''' Parse a Range header for a file of the given size into a list of
+    (first, last) byte positions, inclusive. Returns None if the header isn't
+    a byte range set we understand, and an empty list if none of its ranges
+    overlap the file. '''
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for r in spec.split(','):
+        first, dash, last = r.strip().partition('-')
+        if not dash or not (first or last) or \
+                not (first.isdigit() or not first) or \
+                not (last.isdigit() or not last):
+            return None
+        if not first:
+            # the last N bytes
+            first, last = max(0, size - int(last)), size - 1
+        else:
+            first = int(first)
+            if last and int(last) < first:
+                return None
+            last = min(int(last), size - 1) if last else size - 1
+        if first <= last:
+            ranges.append((first, last))
+    return ranges
+
+
+def etag_matches(header, etag, weak=True):
+    ''' Whether etag is in the given If-None-Match or If-Range list. Weak
+    comparison ignores W/ prefixes, strong comparison never matches them. '''
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return True
+        if tag.startswith('W/'):
+            if not weak:
+                continue
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+class DirectoryEntries:
+    ''' The sorted (name, is_dir, is_link) entries of a directory, and each
+    of them rendered as an HTML list item and as JSON, made the first time
+    they're needed and kept so later listings only have to join them '''
+    def __init__(self, entries):
+        self.entries = entries
+        self._html = {}
+        self._json = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def html(self, enc):
+        if enc not in self._html:
+            items = []
+            for name, is_dir, is_link in self.entries:
+                displayname = linkname = name
+                # Append / for directories or @ for symbolic links
+                if is_dir:
+                    displayname = linkname = name + '/'
+                if is_link:
+                    displayname = name + '@'
+                items.append(('<li><a href="%s">%s</a></li>\n' % (
+                    urllib.parse.quote(linkname, errors='surrogatepass'),
+                    html.escape(displayname, quote=False))).encode(
+                        enc, 'surrogateescape'))
+            self._html[enc] = items
+        return self._html[enc]
+
+    def json(self):
+        if self._json is None:
+            self._json = [json.dumps({
+                'name': name,
+                'type': 'dir' if is_dir else 'file',
+                'link': is_link,
+            }).encode() for name, is_dir, is_link in self.entries]
+        return self._json
+
+
+def scan_directory(path):
+    ''' Return the DirectoryEntries of the given directory, sorted like
+    SimpleHTTPRequestHandler sorts them. Only symlinks are stat()ed. '''
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            entries.append((entry.name, is_dir, entry.is_symlink()))
+    entries.sort(key=lambda e: e[0].lower())
+    return DirectoryEntries(entries)
+
+
+class ListingCache:
+    ''' The DirectoryEntries of the max_entries most recently listed
+    directories, keyed on the directory's inode and mtime so that a changed
+    directory is scanned again. Safe to use from many threads. '''
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, path):
+        # stat before scanning, so a change made during the scan makes the
+        # next request scan again
+        st = os.stat(path)
+        key = (st.st_dev, st.st_ino, st.st_mtime_ns)
+        with self.lock:
+            cached = self.entries.get(path)
+            if cached is not None and cached[0] == key:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+        entries = scan_directory(path)
+        with self.lock:
+            self.entries[path] = (key, entries)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entries
+
+    def counters(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self.entries),
+                    'max_entries': self.max_entries}
+
+
+class Listing:
+    ''' A response body made by a generator of bytes, sent a piece at a time
+    with chunked encoding '''
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def close(self):
+        self.chunks.close()
+
+
+def listing_html(entries, displaypath, offset, limit, query, enc):
+    ''' Yield the HTML SimpleHTTPRequestHandler would have made for the given
+    slice of entries, a piece at a time, with links to the neighboring pages
+    if it's only a slice '''
+    title = 'Directory listing for %s' % (displaypath,)
+    head = [
+        '<!DOCTYPE HTML>', '<html lang="en">', '<head>',
+        '<meta charset="%s">' % (enc,),
+        '<title>%s</title>\n</head>' % (title,),
+        '<body>\n<h1>%s</h1>' % (title,)]
+    end = len(entries) if limit is None else min(len(entries), offset + limit)
+    pages = []
+    if limit is not None:
+        pages.append('<p>%d to %d of %d' % (
+            min(offset + 1, end), end, len(entries)))
+        for label, start in [('previous', max(0, offset - limit)),
+                             ('next', end)]:
+            if (label == 'previous' and offset) or \
+                    (label == 'next' and end < len(entries)):
+                q = dict(query, offset=start, limit=limit)
+                pages.append('<a href="?%s">%s</a>' % (
+                    html.escape(urllib.parse.urlencode(q)), label))
+        pages[-1] += '</p>'
+    yield '\n'.join(head + pages + ['<hr>\n<ul>\n']).encode(
+        enc, 'surrogateescape')
+    items = entries.html(enc)
+    for i in range(offset, end, LISTING_CHUNK):
+        yield b''.join(items[i:min(end, i + LISTING_CHUNK)])
+    yield '\n'.join(['</ul>\n<hr>'] + pages +
+                     ['</body>\n</html>\n']).encode(enc, 'surrogateescape')
+
+
+def listing_json(entries, offset, limit):
+    ''' Yield the given slice of entries as a JSON object, a piece at a
+    time '''
+    end = len(entries) if limit is None else min(len(entries), offset + limit)
+    yield ('{"total": %d, "offset": %d, "limit": %s, "entries": [' % (
+        len(entries), offset, json.dumps(limit))).encode()
+    items = entries.json()
+    for i in range(offset, end, LISTING_CHUNK):
+        yield (b', ' if i > offset else b'') + \
+            b', '.join(items[i:min(end, i + LISTING_CHUNK)])
+    yield b']}\n'
+
+
+def accepts_gzip(header):
+    ''' Whether the given Accept-Encoding header allows gzip '''
+    qvalues = {}
+    for item in header.split(','):
+        coding, *params = item.split(';')
+        q = 1.0
+        for param in params:
+            name, _, value = param.strip().partition('=')
+            if name.lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding.strip().lower()] = q
+    return qvalues.get('gzip', qvalues.get('x-gzip', qvalues.get('*', 0))) > 0
+
+
+def not_after(header, mtime):
+    ''' Whether the HTTP date in header is at or after mtime, to the second.
+    Dates that don't parse are never. '''
+    try:
+        date = parsedate_to_datetime(header)
+    except (TypeError, IndexError, OverflowError, ValueError):
+        return False
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return int(mtime) <= date.timestamp()
+
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.timeout = self.server.idle_timeout
+        super().setup()
+        # Responses are written in a few pieces (headers, then the body or its
+        # chunks). Don't let Nagle hold the last one back waiting for an ACK.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        ''' Handle requests until the client has no more waiting, then set
+        self.parked and return, leaving the open connection to the server
+        instead of waiting for the next request on this worker '''
+        self.parked = False
+        self.handle_one_request()
+        while not self.close_connection:
+            if not self.request_waiting():
+                self.parked = True
+                return
+            self.handle_one_request()
+
+    def request_waiting(self):
+        ''' Whether there's more to read from the client right now, either
+        already buffered or in the socket, without waiting for it '''
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            self.close_connection = True
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def finish(self):
+        if not self.parked:
+            super().finish()
+
+    def send_head(self):
+        ''' Like SimpleHTTPRequestHandler.send_head, but for regular files
+        also send an ETag, answer conditional requests, and set self.ranges
+        (and self.parts, the multipart headers before each range) if only
+        some of the file should be sent. Directory listings and errors are
+        left to SimpleHTTPRequestHandler. '''
+        self.ranges = self.parts = None
+        if self.path.split('?', 1)[0] == STATS_PATH and \
+                (self.server.cache or self.server.listings):
+            return self.send_stats()
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) and path.endswith('/'):
+            for index in 'index.html', 'index.htm':
+                if os.path.isfile(os.path.join(path, index)):
+                    path = os.path.join(path, index)
+                    break
+        if path.endswith('/') or not os.path.isfile(path):
+            return super().send_head()
+        ctype = self.guess_type(path)
+        compressible = ctype.startswith(COMPRESSIBLE_TYPES)
+        use_gzip = compressible and \
+            accepts_gzip(self.headers.get('Accept-Encoding', ''))
+        try:
+            st = os.stat(path)
+            cached = self.server.cache and \
+                self.server.cache.get(path, st, use_gzip)
+            if cached:
+                data, encoding = cached
+                f, size = io.BytesIO(data), len(data)
+            else:
+                f, encoding = open(path, 'rb'), None
+                st = os.fstat(f.fileno())
+                size = st.st_size
+        except OSError:
+            self.send_error(http.HTTPStatus.NOT_FOUND, 'File not found')
+            return None
+        try:
+            return self.send_file_head(
+                f, st, size, ctype, encoding, compressible)
+        except:
+            f.close()
+            raise
+
+    def send_stats(self):
+        counters = {}
+        if self.server.cache:
+            counters.update(self.server.cache.counters())
+        if self.server.listings:
+            counters['listings'] = self.server.listings.counters()
+        data = json.dumps(counters, indent=2).encode()
+        self.send_response(http.HTTPStatus.OK)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        return io.BytesIO(data)
+
+    def send_file_head(self, f, st, size, ctype, encoding, compressible):
+        ''' Send the headers for the file f, whose os.stat() is st, and which
+        is size bytes long in the given encoding '''
+        etag = '"%x-%x%s"' % (
+            st.st_mtime_ns, st.st_size, '-gz' if encoding else '')
+        last_modified = self.date_time_string(st.st_mtime)
+        validators = [
+            ('ETag', etag),
+            ('Last-Modified', last_modified),
+            ('Accept-Ranges', 'bytes')]
+        if encoding:
+            validators.append(('Content-Encoding', encoding))
+        if compressible:
+            validators.append(('Vary', 'Accept-Encoding'))
+        inm = self.headers.get('If-None-Match')
+        ims = self.headers.get('If-Modified-Since')
+        if (etag_matches(inm, etag) if inm is not None
+                else ims is not None and not_after(ims, st.st_mtime)):
+            self.send_response(http.HTTPStatus.NOT_MODIFIED)
+            for header in validators:
+                self.send_header(*header)
+            self.end_headers()
+            f.close()
+            return None
+        ranges = None
+        if 'Range' in self.headers and self.command == 'GET':
+            if_range = self.headers.get('If-Range')
+            if if_range is None or (
+                    etag_matches(if_range, etag, weak=False)
+                    if if_range.lstrip().startswith(('"', 'W/'))
+                    else if_range.strip() == last_modified):
+                ranges = parse_ranges(self.headers['Range'], size)
+        if ranges is not None and len(ranges) > MAX_RANGES:
+            ranges = None
+        if ranges == []:
+            self.send_response(
+                http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header('Content-Range', 'bytes */%d' % (size,))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            f.close()
+            return None
+        if ranges is None:
+            self.send_response(http.HTTPStatus.OK)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(size))
+        elif len(ranges) == 1:
+            first, last = ranges[0]
+            self.send_response(http.HTTPStatus.PARTIAL_CONTENT)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                first, last, size))
+            self.send_header('Content-Length', str(last - first + 1))
+        else:
+            self.parts = [(
+                '\r\n--%s\r\nContent-Type: %s\r\n'
+                'Content-Range: bytes %d-%d/%d\r\n\r\n' % (
+                    BOUNDARY, ctype, first, last, size)).encode('latin-1')
+                for first, last in ranges]
+            self.parts.append(('\r\n--%s--\r\n' % (BOUNDARY,)).encode())
+            self.send_response(http.HTTPStatus.PARTIAL_CONTENT)
+            self.send_header(
+                'Content-Type', 'multipart/byteranges; boundary=' + BOUNDARY)
+            self.send_header('Content-Length', str(
+                sum(len(p) for p in self.parts) +
+                sum(last - first + 1 for first, last in ranges)))
+        for header in validators:
+            self.send_header(*header)
+        self.end_headers()
+        self.ranges = ranges
+        return f
+
+    def list_directory(self, path):
+        ''' Replaces SimpleHTTPRequestHandler.list_directory, which lists,
+        sorts, and renders the whole directory on every request, with one
+        that reuses the sorted entries until the directory changes and sends
+        only the requested page of them, as HTML or JSON, a piece at a
+        time '''
+        urlpath, _, query = self.path.partition('?')
+        query = dict(urllib.parse.parse_qsl(query))
+        try:
+            offset = int(query.get('offset', 0))
+            limit = int(query['limit']) if 'limit' in query else None
+            if offset < 0 or (limit is not None and limit < 1):
+                raise ValueError()
+        except ValueError:
+            self.send_error(http.HTTPStatus.BAD_REQUEST,
+                            'offset and limit must be positive integers')
+            return None
+        try:
+            if self.server.listings:
+                entries = self.server.listings.get(path)
+            else:
+                entries = scan_directory(path)
+        except OSError:
+            self.send_error(http.HTTPStatus.NOT_FOUND,
+                            'No permission to list directory')
+            return None
+        self.send_response(http.HTTPStatus.OK)
+        if query.get('format') == 'json':
+            self.send_header('Content-Type', 'application/json')
+            chunks = listing_json(entries, offset, limit)
+        else:
+            try:
+                displaypath = urllib.parse.unquote(
+                    urlpath, errors='surrogatepass')
+            except UnicodeDecodeError:
+                displaypath = urllib.parse.unquote(urlpath)
+            enc = sys.getfilesystemencoding()
+            self.send_header('Content-Type', 'text/html; charset=%s' % (enc,))
+            chunks = listing_html(
+                entries, html.escape(displaypath, quote=False),
+                offset, limit, query, enc)
+        if self.request_version == 'HTTP/1.1':
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            # no way to say where the body ends but closing the connection
+            self.close_connection = True
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        return Listing(chunks)
+
+    def send_range(self, source, first, count=None):
+        ''' Send count bytes (or all the rest) of source from offset first:
+        open files with sendfile(2), and bodies in memory, like cached files
+        and directory listings, without copying them '''
+        if isinstance(source, io.BytesIO):
+            end = None if count is None else first + count
+            self.wfile.write(memoryview(source.getvalue())[first:end])
+        else:
+            self.connection.sendfile(source, first, count)
+
+    def copyfile(self, source, outputfile):
+        ''' Send the body, only the requested ranges of it if any '''
+        if isinstance(source, Listing):
+            chunked = self.request_version == 'HTTP/1.1'
+            for chunk in source.chunks:
+                if not chunk:
+                    continue
+                if chunked:
+                    chunk = b'%x\r\n%s\r\n' % (len(chunk), chunk)
+                outputfile.write(chunk)
+            if chunked:
+                outputfile.write(b'0\r\n\r\n')
+        elif not self.ranges:
+            self.send_range(source, 0)
+        elif not self.parts:
+            first, last = self.ranges[0]
+            self.send_range(source, first, last - first + 1)
+        else:
+            for (first, last), part in zip(self.ranges, self.parts):
+                outputfile.write(part)
+                self.send_range(source, first, last - first + 1)
+            outputfile.write(self.parts[-1])
+
+
+class PooledHTTPServer(http.server.HTTPServer):
+    ''' Handles requests on one of a fixed number of worker threads. Requests
+    that arrive while all workers are busy wait their turn.
+
+    Between requests, a keep-alive connection is parked: a single thread
+    watches all of them with a selector, hands each one back to the pool when
+    its next request arrives, and closes those idle for idle_timeout seconds.
+    So idle connections cost a file descriptor each, not a worker. '''
+    request_queue_size = 1024
+
+    def __init__(self, addr, handler, workers, idle_timeout, cache=None,
+                 listings=None):
+        super().__init__(addr, handler)
+        self.idle_timeout = idle_timeout
+        self.cache = cache
+        self.listings = listings
+        self.pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='worker')
+        self.selector = selectors.DefaultSelector()
+        # workers hand over connections to park through to_park, and wake the
+        # parking thread up with a byte on the socketpair
+        self.to_park = deque()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+
+    def serve_forever(self, *args, **kwargs):
+        # started here rather than in __init__ so that it's in the process
+        # that serves, if that's a child forked after making the server
+        threading.Thread(
+            target=self.park_loop, name='parking', daemon=True).start()
+        super().serve_forever(*args, **kwargs)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            return
+        self.handled(handler)
+
+    def resume(self, handler):
+        ''' Worker entry point for a parked connection with a new request '''
+        try:
+            handler.handle()
+        except Exception:
+            handler.parked = False
+            self.handle_error(handler.request, handler.client_address)
+        handler.finish()
+        self.handled(handler)
+
+    def handled(self, handler):
+        if not handler.parked:
+            self.shutdown_request(handler.request)
+            return
+        self.to_park.append(handler)
+        try:
+            self.wake_w.send(b'\0')
+        except BlockingIOError:
+            # the parking thread has plenty of wake ups waiting already
+            pass
+
+    def close_parked(self, handler):
+        handler.parked = False
+        handler.finish()
+        self.shutdown_request(handler.request)
+
+    def park_loop(self):
+        interval = min(1, self.idle_timeout / 4)
+        while True:
+            try:
+                events = self.selector.select(interval)
+            except (OSError, ValueError):
+                # the selector was closed by server_close()
+                return
+            now = time.monotonic()
+            for key, _ in events:
+                if key.fileobj is self.wake_r:
+                    try:
+                        while self.wake_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    while self.to_park:
+                        handler = self.to_park.popleft()
+                        self.selector.register(
+                            handler.connection, selectors.EVENT_READ,
+                            (handler, now + self.idle_timeout))
+                    continue
+                self.selector.unregister(key.fileobj)
+                self.pool.submit(self.resume, key.data[0])
+            for key in list(self.selector.get_map().values()):
+                if key.data and key.data[1] < now:
+                    self.selector.unregister(key.fileobj)
+                    self.close_parked(key.data[0])
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        for key in list(self.selector.get_map().values()):
+            if key.data:
+                self.close_parked(key.data[0])
+        self.selector.close()
+
+
+def make_server(addr, workers, idle_timeout, cache=None, listings=None):
+    if not workers:
+        return http.server.HTTPServer(
+            addr, http.server.SimpleHTTPRequestHandler)
+    return PooledHTTPServer(
+        addr, Handler, workers, idle_timeout, cache, listings)
+
+
+def make_cache(args):
+    if not args.cache_size:
+        return None
+    return ContentCache(
+        args.cache_size, args.cache_entries, args.cache_file_size)
+
+
+def make_listing_cache(args):
+    if not args.listing_cache:
+        return None
+    return ListingCache(args.listing_cache)
+
+
+def fork_server(directory, workers, idle_timeout, cache=None, listings=None):
+    ''' Start a server for directory on a free port in a child process, with
+    its request logging thrown away. Returns the port and the child's pid. '''
+    httpd = make_server(
+        ('127.0.0.1', 0), workers, idle_timeout, cache, listings)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.chdir(directory)
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, 2)
+            httpd.serve_forever()
+        finally:
+            os._exit(0)
+    port = httpd.server_address[1]
+    httpd.socket.close()
+    return port, pid
+
+
+def fetch_loop(port, path, end, results):
+    ''' GET path over and over on new connections until time end. Appends the
+    number of responses and body bytes to results. '''
+    buf = bytearray(1024 * 1024)
+    count = num_bytes = 0
+    while time.monotonic() < end:
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        conn.request('GET', path)
+        resp = conn.getresponse()
+        n = resp.readinto(buf)
+        while n:
+            num_bytes += n
+            n = resp.readinto(buf)
+        conn.close()
+        count += 1
+    results.append((count, num_bytes))
+
+
+def benchmark(args):
+    ''' Serve some generated files with the old single-threaded server and
+    with this one, fetch them from --benchmark-clients threads, and print how
+    fast each server was. Also list a directory of BENCHMARK_LISTING_SIZE
+    files. The clients share the machine with the server, so these are lower
+    bounds. '''
+    directory = tempfile.mkdtemp(prefix='simple-http-server-')
+    try:
+        for name, size in BENCHMARK_FILES:
+            with open(os.path.join(directory, name), 'wb') as fd:
+                fd.truncate(size)
+        os.mkdir(os.path.join(directory, 'listing'))
+        for i in range(BENCHMARK_LISTING_SIZE):
+            os.close(os.open(os.path.join(
+                directory, 'listing', 'result-%06d.txt' % (i,)),
+                os.O_CREAT | os.O_WRONLY))
+        names = [name for name, _ in BENCHMARK_FILES] + ['listing/']
+        pooled = '%d workers' % (args.workers,)
+        for label, workers, cache, listings in [
+                ('http.server', 0, None, None),
+                (pooled + ', no cache', args.workers, None, None),
+                (pooled, args.workers, make_cache(args),
+                 make_listing_cache(args))]:
+            port, pid = fork_server(
+                directory, workers, args.idle_timeout, cache, listings)
+            try:
+                for name in names:
+                    results = []
+                    end = time.monotonic() + args.benchmark_seconds
+                    clients = [threading.Thread(
+                        target=fetch_loop,
+                        args=(port, '/' + name, end, results))
+                        for _ in range(args.benchmark_clients)]
+                    start = time.monotonic()
+                    for t in clients:
+                        t.start()
+                    for t in clients:
+                        t.join()
+                    duration = time.monotonic() - start
+                    count = sum(r[0] for r in results)
+                    num_bytes = sum(r[1] for r in results)
+                    print('%-22s %-8s %8.0f req/s %7.2f Gbps' % (
+                        label, name, count / duration,
+                        num_bytes * 8 / duration / 1000 / 1000 / 1000))
+            finally:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+    finally:
+        shutil.rmtree(directory)
+
+
+def self_test(args):
+    ''' Serve some generated files, with and without the cache, and check
+    over one connection from a local client that full, partial, conditional,
+    and gzipped GETs get the right status and the right bytes, and that the
+    connection is reused and then closed once idle. Returns the number of
+    failed checks. '''
+    directory = tempfile.mkdtemp(prefix='simple-http-server-')
+    data = os.urandom(100 * 1000)
+    text = b''.join(b'%d bottles of beer on the wall\n' % (i,)
+                    for i in range(1000))
+    with open(os.path.join(directory, 'data.bin'), 'wb') as fd:
+        fd.write(data)
+    with open(os.path.join(directory, 'data.txt'), 'wb') as fd:
+        fd.write(text)
+    failures = []
+    try:
+        os.mkdir(os.path.join(directory, 'dir'))
+        for name in ['b', 'A', 'c d&e', 'sub']:
+            if name == 'sub':
+                os.mkdir(os.path.join(directory, 'dir', name))
+            else:
+                open(os.path.join(directory, 'dir', name), 'w').close()
+        for cache, listings in [
+                (None, None),
+                (ContentCache(1024 * 1024, 16, 1024 * 1024), ListingCache(4))]:
+            print('--- with%s the caches' % ('' if cache else 'out',))
+            failures.extend(self_test_server(
+                directory, args.workers or 1, cache, listings, data, text))
+    finally:
+        shutil.rmtree(directory)
+    return len(failures)
+
+
+def self_test_server(directory, workers, cache, listings, data, text):
+    port, pid = fork_server(directory, workers, 0.5, cache, listings)
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    failures = []
+
+    def get(headers={}, method='GET', path='/data.bin'):
+        conn.request(method, path, headers=headers)
+        resp = conn.getresponse()
+        return resp, resp.read()
+
+    def check(name, ok):
+        print('%-4s %s' % ('ok' if ok else 'FAIL', name))
+        if not ok:
+            failures.append(name)
+
+    try:
+        resp, body = get()
+        sock = conn.sock
+        etag = resp.getheader('ETag')
+        modified = resp.getheader('Last-Modified')
+        check('GET is 200 with the whole file',
+              resp.status == 200 and body == data and etag and modified)
+        resp, body = get(method='HEAD')
+        check('HEAD has no body', resp.status == 200 and body == b'' and
+              resp.getheader('Content-Length') == str(len(data)))
+        for spec, want in [('10-99', data[10:100]), ('-100', data[-100:]),
+                           ('99000-', data[99000:]),
+                           ('99990-200000', data[99990:])]:
+            resp, body = get({'Range': 'bytes=' + spec})
+            check('Range bytes=%s is 206 with those bytes' % (spec,),
+                  resp.status == 206 and body == want)
+        resp, body = get({'Range': 'bytes=0-9,50000-50099,-5'})
+        msg = BytesParser().parsebytes(
+            b'Content-Type: ' + resp.getheader('Content-Type').encode() +
+            b'\r\n\r\n' + body)
+        parts = [p.get_payload(decode=True) for p in msg.get_payload()] \
+            if msg.is_multipart() else []
+        check('multiple ranges are 206 multipart/byteranges',
+              resp.status == 206 and
+              parts == [data[:10], data[50000:50100], data[-5:]])
+        resp, body = get({'Range': 'bytes=200000-'})
+        check('Range past the end is 416', resp.status == 416 and
+              resp.getheader('Content-Range') == 'bytes */%d' % (len(data),))
+        resp, body = get({'Range': 'lines=1-2'})
+        check('Range in other units is ignored',
+              resp.status == 200 and body == data)
+        resp, body = get({'If-None-Match': etag})
+        check('If-None-Match with the ETag is 304',
+              resp.status == 304 and body == b'')
+        resp, body = get({'If-None-Match': '"nope"',
+                          'If-Modified-Since': modified})
+        check('If-None-Match with another ETag is 200, whatever the date',
+              resp.status == 200 and body == data)
+        resp, body = get({'If-Modified-Since': modified})
+        check('If-Modified-Since Last-Modified is 304', resp.status == 304)
+        resp, body = get({'If-Modified-Since':
+                          'Thu, 01 Jan 1970 00:00:00 GMT'})
+        check('If-Modified-Since long ago is 200', resp.status == 200)
+        resp, body = get({'Range': 'bytes=0-9', 'If-Range': etag})
+        check('If-Range with the ETag is 206',
+              resp.status == 206 and body == data[:10])
+        resp, body = get({'Range': 'bytes=0-9', 'If-Range': '"old"'})
+        check('If-Range with another ETag is 200 with the whole file',
+              resp.status == 200 and body == data)
+        gz = {'Accept-Encoding': 'gzip, deflate'}
+        resp, body = get(gz)
+        check('binary files are never gzipped',
+              resp.getheader('Content-Encoding') is None and body == data)
+        resp, body = get(path='/data.txt')
+        text_etag = resp.getheader('ETag')
+        check('text is plain without Accept-Encoding: gzip',
+              resp.status == 200 and body == text and
+              resp.getheader('Content-Encoding') is None and
+              resp.getheader('Vary') == 'Accept-Encoding')
+        resp, body = get({'Accept-Encoding': 'gzip;q=0, identity'},
+                         path='/data.txt')
+        check('text is plain with gzip;q=0', body == text and
+              resp.getheader('Content-Encoding') is None)
+        resp, body = get(gz, path='/data.txt')
+        gz_etag = resp.getheader('ETag')
+        if cache:
+            check('text is gzipped with Accept-Encoding: gzip',
+                  resp.getheader('Content-Encoding') == 'gzip' and
+                  gzip.decompress(body) == text and gz_etag != text_etag and
+                  len(body) < len(text))
+            resp, body = get(dict(gz, Range='bytes=0-9'), path='/data.txt')
+            check('Range of gzipped text is of the gzipped bytes',
+                  resp.status == 206 and len(body) == 10 and
+                  resp.getheader('Content-Encoding') == 'gzip')
+            resp, body = get(dict(gz, **{'If-None-Match': text_etag}),
+                             path='/data.txt')
+            check('plain ETag does not match gzipped text',
+                  resp.status == 200)
+            resp, body = get(path=STATS_PATH)
+            stats = json.loads(body)
+            check('cache stats count hits and misses',
+                  resp.status == 200 and stats['misses'] == 2 and
+                  stats['hits'] > 10 and stats['gzip_misses'] == 1 and
+                  stats['gzip_hits'] == 2 and stats['entries'] == 3)
+        else:
+            check('text is plain without the cache',
+                  resp.getheader('Content-Encoding') is None and
+                  body == text)
+        names = ['A', 'b', 'c d&e', 'sub']
+        resp, body = get(path='/dir/')
+        check('listing is chunked HTML of every entry in order',
+              resp.status == 200 and
+              resp.getheader('Transfer-Encoding') == 'chunked' and
+              b'<a href="sub/">sub/</a>' in body and
+              b'<a href="c%20d%26e">c d&amp;e</a>' in body and
+              [body.index(n.encode()) for n in ['>A<', '>b<', '>c d', '>sub']]
+              == sorted(body.index(n.encode())
+                        for n in ['>A<', '>b<', '>c d', '>sub']))
+        resp, body = get(path='/dir/?format=json')
+        listing = json.loads(body)
+        check('JSON listing has every entry in order',
+              listing['total'] == 4 and
+              [e['name'] for e in listing['entries']] == names and
+              listing['entries'][3]['type'] == 'dir')
+        resp, body = get(path='/dir/?format=json&offset=1&limit=2')
+        listing = json.loads(body)
+        check('JSON listing pages',
+              [e['name'] for e in listing['entries']] == names[1:3])
+        resp, body = get(path='/dir/?limit=2')
+        check('HTML listing pages', b'sub/' not in body and
+              b'<a href="?limit=2&amp;offset=2">next</a>' in body)
+        new = os.path.join(directory, 'dir', 'new')
+        open(new, 'w').close()
+        try:
+            resp, body = get(path='/dir/?format=json')
+            listing = json.loads(body)
+        finally:
+            os.unlink(new)
+        check('listing shows a new file', 'new' in
+              [e['name'] for e in listing['entries']])
+        if listings:
+            resp, body = get(path=STATS_PATH)
+            stats = json.loads(body)['listings']
+            check('listing cache counts hits and misses',
+                  stats['misses'] == 2 and stats['hits'] == 3)
+        check('all of that was one connection', conn.sock is sock)
+        time.sleep(1)
+        sock.settimeout(5)
+        try:
+            closed = sock.recv(1) == b''
+        except (socket.timeout, ConnectionError):
+            closed = False
+        check('idle connection is closed by the server', closed)
+        conn.close()
+        idle = []
+        try:
+            for _ in range(workers + 1):
+                c = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+                c.request('GET', '/data.bin')
+                c.getresponse().read()
+                idle.append(c)
+            c = http.client.HTTPConnection('127.0.0.1', port, timeout=0.4)
+            try:
+                c.request('GET', '/data.bin')
+                served = c.getresponse().read() == data
+            except socket.timeout:
+                served = False
+            c.close()
+        finally:
+            for c in idle:
+                c.close()
+        check('more idle connections than workers don\'t stall new clients',
+              served)
+        resp, body = get(path='/missing')
+        check('missing file is 404', resp.status == 404)
+        if not cache:
+            resp, body = get(path=STATS_PATH)
+            check('no cache stats without the cache', resp.status == 404)
+        resp, body = get(path='/dir/?limit=none')
+        check('bad listing limit is 400', resp.status == 400)
+    finally:
+        conn.close()
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+    return failures
+
 
 def main(args):
+    if args.benchmark:
+        return benchmark(args)
+    if args.self_test:
+        return self_test(args)
     os.chdir(args.directory)
     addr = ('' ,args.port)
-    print('Serving', args.directory, 'on', addr)
-    httpd = http.server.HTTPServer(addr, http.server.SimpleHTTPRequestHandler)
+    print('Serving', args.directory, 'on', addr, 'with',
+            args.workers or 'no', 'worker threads')
+    httpd = make_server(
+        addr, args.workers, args.idle_timeout, make_cache(args),
+        make_listing_cache(args))
     httpd.serve_forever()
 
 if __name__ == '__main__':
@@ -15,6 +1076,36 @@ if __name__ == '__main__':
             help='Port on which to listen')
     parser.add_argument('-d', '--directory', metavar='DIR', default=os.getcwd(),
             help='Directory to serve')
+    parser.add_argument('-w', '--workers', default=64, type=int,
+            help='Most connections to handle at once. 0 means use the '
+            'single-threaded http.server, which copies files through Python')
+    parser.add_argument('--idle-timeout', default=15, type=float,
+            help='Seconds to keep an idle connection open, or to wait on a '
+            'client that has stopped reading')
+    parser.add_argument('--cache-size', default=64 * 1024 * 1024, type=int,
+            metavar='BYTES',
+            help='Most bytes of file contents (plain and gzipped) to keep in '
+            'memory. 0 disables the cache')
+    parser.add_argument('--cache-entries', default=4096, type=int,
+            help='Most files (plain and gzipped counted separately) to keep '
+            'in memory')
+    parser.add_argument('--cache-file-size', default=1024 * 1024, type=int,
+            metavar='BYTES',
+            help='Only cache files at most this big. Bigger ones are always '
+            'sent straight from disk, and never gzipped')
+    parser.add_argument('--listing-cache', default=64, type=int,
+            metavar='DIRS',
+            help='Number of directories to keep sorted listings of in '
+            'memory. 0 disables the cache')
+    parser.add_argument('--self-test', action='store_true',
+            help='Check Range, conditional GET, and keep-alive handling and '
+            'exit')
+    parser.add_argument('--benchmark', action='store_true',
+            help='Compare this server with http.server and exit')
+    parser.add_argument('--benchmark-seconds', default=2, type=float,
+            help='How long to fetch each file for with --benchmark')
+    parser.add_argument('--benchmark-clients', default=16, type=int,
+            help='Number of concurrent clients with --benchmark')
     args = parser.parse_args()
     try: exit(main(args))
     except KeyboardInterrupt as e: pass
@@ -1,9 +1,69 @@
 from datetime import datetime
+from itertools import count
+import signal
+import sys
+import threading
+import time
+
+# Flight recorder state, see flight_recorder()
+_times = None
+_msgs = None
+_next = None
+_clock_offset = None
+
+def flight_recorder(size=10000, sig=signal.SIGUSR1, fd=None):
+    ''' Stop printing log() and warn() messages and instead keep the last size
+    of them in memory, with no formatting or I/O. They're printed (to fd, or
+    stdout) on fail_hard(), on an unhandled exception in any thread, and
+    whenever the process gets the signal sig. Call from the main thread. '''
+    global _times, _msgs, _next, _clock_offset
+    _clock_offset = time.time() - time.monotonic()
+    _times, _msgs, _next = [None] * size, [None] * size, count()
+    _dump = lambda reason: dump(reason, fd)
+    prev_excepthook = sys.excepthook
+    def excepthook(*args):
+        _dump('unhandled exception')
+        prev_excepthook(*args)
+    sys.excepthook = excepthook
+    prev_thread_excepthook = threading.excepthook
+    def thread_excepthook(args):
+        _dump('unhandled exception in thread {}'.format(args.thread.name))
+        prev_thread_excepthook(args)
+    threading.excepthook = thread_excepthook
+    if sig is not None:
+        signal.signal(sig, lambda signum, frame:
+            _dump('signal {}'.format(signal.Signals(signum).name)))
+
+def dump(reason='dump()', fd=None):
+    ''' Print the messages the flight recorder has, oldest first '''
+    if _times is None: return
+    end, size = next(_next), len(_times)
+    start = max(0, end - size)
+    records = [(_times[i % size], _msgs[i % size]) for i in range(start, end)]
+    # skip slots being written as we read them
+    records = [(t, msg) for t, msg in records
+        if t is not None and msg is not None]
+    fd = fd or sys.stdout
+    print('--- flight recorder, {}: last {} messages ---'.format(
+        reason, len(records)), file=fd)
+    for t, msg in records:
+        print('[{}]'.format(datetime.fromtimestamp(_clock_offset + t)),
+            *msg, file=fd)
+    print('--- end of flight recorder ---', file=fd, flush=True)
+    # we took index end, so nobody will write to its slot this time around
+    _times[end % size] = None
+
 def log(*msg):
+    if _times is not None:
+        # itertools.count is atomic, so every thread gets its own slot
+        i = next(_next) % len(_times)
+        _times[i], _msgs[i] = time.monotonic(), msg
+        return
     ts = '[{}]'.format(datetime.now())
     if msg: print(ts,*msg)
 def warn(*msg):
     if msg: log('[WARN]',*msg)
 def fail_hard(*msg):
     if msg: log('[ERROR]',*msg)
+    if _times is not None: dump('fail_hard()')
     exit(1)
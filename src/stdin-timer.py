@@ -2,53 +2,833 @@
 '''
 Continuously reads data on stdin until there is no more data. Records how many
 bytes there were and how long it took to read them. Prints this information.
+
+Data is read into one preallocated buffer, or when stdin is a pipe, spliced
+straight to /dev/null without ever being copied into this process. Run with
+--benchmark to see how fast this machine can go, so you know whether a
+measurement is limited by the tool or by what's feeding it.
+
+With --passthrough, the data is copied to stdout instead, so it can measure
+(and with --rate-limit, throttle) one stage of a pipeline in place, like pv:
+
+    tar c dir | ./stdin-timer.py -p --rate-limit 100 | ssh host tar x
 '''
-import time
+import fcntl
+import json
+import os
+import selectors
+import socket
+import stat
+import subprocess
 import sys
 import threading
+import time
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 
-write_lock = threading.Lock()
-thread_done = threading.Event()
+METHODS = ['auto', 'read', 'readinto', 'splice']
 
-def report(stop_ev, start_time, last_byte_count):
-    if stop_ev.is_set():
-        thread_done.set()
-        return
-    global byte_count
-    b = byte_count - last_byte_count
-    t = time.time() - start_time
-    r = b / t * 8 / 1000 / 1000
-    with write_lock:
-        print(
-            '%d bytes in %f seconds (%0.2f Mbps)' % (b, t, r),
-            file=sys.stderr)
-    threading.Timer(1, report, [stop_ev, time.time(), byte_count]).start()
-
-# Don't record the start time until we've read the first byte
-fd = open('/dev/stdin', 'rb')
-fd.read(1)
-byte_count = 1
-stop_ev = threading.Event()
-threading.Timer(1, report, [stop_ev, time.time(), byte_count]).start()
-start = time.time()
-# Keep reading until no more data
-data = 'foo'
-try:
+
+def percentile(values, p):
+    ''' The p-th percentile of the sorted list values, interpolating between
+    the closest two like numpy does '''
+    if not values:
+        return None
+    i = (len(values) - 1) * p / 100
+    lo = int(i)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (i - lo)
+
+
+def summarize(values):
+    values = sorted(values)
+    return {
+        'min': values[0] if values else None,
+        'median': percentile(values, 50),
+        'p99': percentile(values, 99),
+        'max': values[-1] if values else None,
+    }
+
+
+def log2_histogram(values):
+    ''' Return [low, high, count] for each non-empty power of two bucket of
+    the given non-negative values. The first bucket is [0, 1). '''
+    counts = {}
+    for v in values:
+        b = int(v).bit_length()
+        counts[b] = counts.get(b, 0) + 1
+    return [bucket_bounds(b) + [counts[b]] for b in sorted(counts)]
+
+
+def bucket_bounds(b):
+    return [0 if b == 0 else 1 << (b - 1), 1 << b]
+
+
+def mbps(num_bytes, seconds):
+    return num_bytes * 8 / seconds / 1000 / 1000 if seconds else 0.0
+
+
+class Stats:
+    ''' Throughput statistics for one stream, or the total of several.
+
+    The reading thread calls add() after every read and finish() at EOF. A
+    Sampler calls sample() every interval seconds to record how many bytes
+    came in since the last sample.
+
+    The time between consecutive reads is kept in a histogram of power of two
+    microsecond buckets. Any gap of at least stall seconds is recorded as a
+    stall. '''
+    def __init__(self, name='stdin', interval=1.0, stall=1.0):
+        self.name = name
+        self.interval = interval
+        self.stall = stall
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.reads = 0
+        self.gap_counts = [0] * 64
+        self.min_gap = None
+        self.max_gap = 0.0
+        self.stalls = []
+        # (seconds since start at the end of the sample, bytes, seconds long)
+        self.samples = []
+        self.start_time = self.last_read = self.end_time = None
+        self.sampled_bytes = self.sampled_time = None
+
+    def start(self, num_bytes=0):
+        ''' Start the clock. num_bytes were already read to know when to start
+        it, so they're counted in the total but not in any sample. '''
+        with self.lock:
+            self.start_time = self.last_read = time.monotonic()
+            self.bytes = self.sampled_bytes = num_bytes
+            self.sampled_time = self.start_time
+
+    def add(self, n):
+        now = time.monotonic()
+        with self.lock:
+            self.bytes += n
+            self.reads += 1
+            gap = now - self.last_read
+            self.last_read = now
+        self.gap_counts[int(gap * 1000000).bit_length()] += 1
+        if self.min_gap is None or gap < self.min_gap:
+            self.min_gap = gap
+        if gap > self.max_gap:
+            self.max_gap = gap
+        if gap >= self.stall:
+            self.stalls.append((now - gap - self.start_time, gap))
+
+    def _sample(self, t):
+        if t <= self.sampled_time:
+            return None
+        sample = (t - self.start_time, self.bytes - self.sampled_bytes,
+                  t - self.sampled_time)
+        self.samples.append(sample)
+        self.sampled_bytes, self.sampled_time = self.bytes, t
+        return sample
+
+    def sample(self, t):
+        ''' Record and return a sample of the bytes read since the last one,
+        up to time t. Returns None if the stream hasn't started or is done. '''
+        with self.lock:
+            if self.start_time is None or self.end_time is not None:
+                return None
+            return self._sample(t)
+
+    def finish(self):
+        ''' Stop the clock. The last sample covers the partial interval up
+        to now. '''
+        with self.lock:
+            if self.start_time is None or self.end_time is not None:
+                return
+            self.end_time = time.monotonic()
+            self._sample(self.end_time)
+
+    def duration(self):
+        ''' Seconds from the first byte to EOF. 0 if there never was a first
+        byte. '''
+        if self.start_time is None:
+            return 0.0
+        return self.end_time - self.start_time
+
+    def rates(self):
+        ''' Mbps of each sample. The last one is left out if it covers less
+        than half an interval, unless it's the only one. '''
+        samples = self.samples
+        if len(samples) > 1 and samples[-1][2] < self.interval / 2:
+            samples = samples[:-1]
+        return [mbps(b, secs) for _, b, secs in samples]
+
+    def gap_percentile(self, p):
+        ''' Upper bound, in seconds, of the p-th percentile read gap '''
+        total = sum(self.gap_counts)
+        seen = 0
+        for b, count in enumerate(self.gap_counts):
+            seen += count
+            if count and seen >= total * p / 100:
+                return bucket_bounds(b)[1] / 1000000
+        return None
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'bytes': self.bytes,
+            'seconds': self.duration(),
+            'mbps': mbps(self.bytes, self.duration()),
+            'reads': self.reads,
+            'interval': self.interval,
+            'interval_mbps': summarize(self.rates()),
+            'interval_mbps_histogram': log2_histogram(self.rates()),
+            'read_gap_seconds': {
+                'min': self.min_gap,
+                'median_upper_bound': self.gap_percentile(50),
+                'p99_upper_bound': self.gap_percentile(99),
+                'max': self.max_gap,
+            },
+            'read_gap_us_histogram': [
+                bucket_bounds(b) + [count]
+                for b, count in enumerate(self.gap_counts) if count],
+            'stall_seconds': self.stall,
+            'stalls': [{'start': t, 'seconds': secs}
+                       for t, secs in self.stalls],
+            'samples': [{'t': t, 'bytes': b, 'seconds': secs,
+                         'mbps': mbps(b, secs)}
+                        for t, b, secs in self.samples],
+        }
+
+
+class Sampler:
+    ''' One thread that samples any number of Stats every interval seconds.
+    It wakes up on deadlines on the monotonic clock, so samples don't drift,
+    and no thread is created per sample or per stream. All streams are
+    sampled at the same moments, so their samples line up.
+
+    live, if given, is called after each round of samples with the seconds
+    since start() and a list of (Stats, sample) for each that had one. '''
+    def __init__(self, interval, live=None):
+        self.interval = interval
+        self.live = live
+        self.stats = []
+        self.lock = threading.Lock()
+        self.stop_ev = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.start_time = None
+
+    def add(self, stats):
+        with self.lock:
+            self.stats.append(stats)
+
+    def start(self):
+        self.start_time = time.monotonic()
+        self.thread.start()
+
+    def _run(self):
+        deadline = self.start_time + self.interval
+        while not self.stop_ev.wait(max(0, deadline - time.monotonic())):
+            now = time.monotonic()
+            with self.lock:
+                all_stats = list(self.stats)
+            samples = [(stats, stats.sample(now)) for stats in all_stats]
+            samples = [(stats, sample) for stats, sample in samples if sample]
+            if self.live and samples:
+                self.live(now - self.start_time, samples)
+            deadline += self.interval
+
+    def stop(self):
+        self.stop_ev.set()
+        self.thread.join()
+
+
+def format_sample(sample):
+    _, b, secs = sample
+    return '%d bytes in %f seconds (%0.2f Mbps)%s' % (
+        b, secs, mbps(b, secs), '' if b else ' STALLED')
+
+
+def print_samples(t, samples):
+    ''' Print the one stream's sample '''
+    for _, sample in samples:
+        print(format_sample(sample), file=sys.stderr)
+
+
+def print_multi_samples(t, samples):
+    ''' Print the total's sample, then each source's '''
+    lines = ['%s: %s' % (stats.name, format_sample(sample))
+             for stats, sample in samples]
+    print('[%0.1fs] %s' % (t, '\n  '.join(lines)), file=sys.stderr)
+
+
+def print_summary(stats, per_source=()):
+    print('OVERALL: %d bytes in %0.2f seconds (%0.2f Mbps)' % (
+        stats.bytes, stats.duration(), mbps(stats.bytes, stats.duration())),
+        file=sys.stderr)
+    rates = summarize(stats.rates())
+    if rates['min'] is not None:
+        print('per %gs interval: min %0.2f, median %0.2f, p99 %0.2f, max '
+              '%0.2f Mbps' % (stats.interval, rates['min'], rates['median'],
+                              rates['p99'], rates['max']), file=sys.stderr)
+    if stats.reads:
+        print('time between reads: median < %s, p99 < %s, max %s; %d '
+              'stalls of %gs or more' % (
+                  fmt_seconds(stats.gap_percentile(50)),
+                  fmt_seconds(stats.gap_percentile(99)),
+                  fmt_seconds(stats.max_gap), len(stats.stalls),
+                  stats.stall), file=sys.stderr)
+    for source in per_source:
+        rates = summarize(source.rates())
+        print('  %s: %d bytes in %0.2f seconds (%0.2f Mbps), median '
+              'interval %0.2f Mbps, %d stalls' % (
+                  source.name, source.bytes, source.duration(),
+                  mbps(source.bytes, source.duration()),
+                  rates['median'] or 0.0, len(source.stalls)),
+              file=sys.stderr)
+
+
+def fmt_seconds(secs):
+    if secs < 0.001:
+        return '%dus' % (secs * 1000000,)
+    if secs < 1:
+        return '%0.1fms' % (secs * 1000,)
+    return '%0.2fs' % (secs,)
+
+
+def write_outputs(stats, args, per_source=None):
+    ''' Write whichever of --json, --csv, and --rates were asked for. With
+    several sources, the CSV and rates are of their total, and the JSON has
+    the total and every source. '''
+    if args.json:
+        out = stats.to_dict()
+        if per_source is not None:
+            out = {'total': out,
+                   'sources': [source.to_dict() for source in per_source]}
+        with open_output(args.json) as fd:
+            json.dump(out, fd, indent=2)
+            fd.write('\n')
+    if args.csv:
+        # seconds since start and Mbps, for plot-xy.py
+        with open_output(args.csv) as fd:
+            fd.write('# seconds,mbps\n')
+            for t, b, secs in stats.samples:
+                fd.write('%f,%f\n' % (t, mbps(b, secs)))
+    if args.rates:
+        # one Mbps per interval, for plot-cdf.py
+        with open_output(args.rates) as fd:
+            for rate in stats.rates():
+                fd.write('%f\n' % (rate,))
+
+
+def open_output(fname):
+    if fname == '-':
+        return os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    return open(fname, 'w')
+
+
+def is_pipe(fd):
+    return stat.S_ISFIFO(os.fstat(fd).st_mode)
+
+
+def choose_method(fd, method):
+    ''' Resolve 'auto' to the fastest method that works for the given fd '''
+    if method != 'auto':
+        return method
+    if hasattr(os, 'splice') and is_pipe(fd):
+        return 'splice'
+    return 'readinto'
+
+
+def make_reader(fd, method, buffer_size):
+    ''' Return a function that consumes up to buffer_size bytes from fd and
+    returns how many it consumed, 0 meaning EOF.
+
+    read: allocate a new bytes object for every read, like fd.read() does
+    readinto: read into the same preallocated buffer every time
+    splice: move the data from fd (which must be a pipe) to /dev/null in the
+        kernel, never copying it to userspace '''
+    if method == 'read':
+        return lambda: len(os.read(fd, buffer_size))
+    if method == 'readinto':
+        bufs = [bytearray(buffer_size)]
+        return lambda: os.readv(fd, bufs)
+    if method == 'splice':
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        return lambda: os.splice(fd, devnull, buffer_size)
+    raise ValueError('Unknown method %s' % (method,))
+
+
+def can_splice(fd_in, fd_out):
+    ''' Whether splice can move data from fd_in to fd_out: one of them must
+    be a pipe, and the kernel refuses to splice to terminals and to files
+    opened for appending '''
+    if not hasattr(os, 'splice') or os.isatty(fd_out):
+        return False
+    if fcntl.fcntl(fd_out, fcntl.F_GETFL) & os.O_APPEND:
+        return False
+    return is_pipe(fd_in) or is_pipe(fd_out)
+
+
+def write_all(fd, data):
     while data:
-        data = fd.read(4096)
-        byte_count += len(data)
-except KeyboardInterrupt:
-    # print('')
-    pass
-finally:
-    stop_ev.set()
-thread_done.wait()
-# Print stats
-end = time.time()
-duration = end - start
-rate = byte_count / duration * 8 / 1000 / 1000
-with write_lock:
-    print('OVERALL: %d bytes in %0.2f seconds (%0.2f Mbps)' %\
-        (byte_count, duration, rate), file=sys.stderr)
-sys.stderr.flush()
-fd.close()
+        data = data[os.write(fd, data):]
+
+
+def make_forwarder(fd_in, fd_out, method, buffer_size):
+    ''' Return a function that moves up to n bytes (at most buffer_size)
+    from fd_in to fd_out and returns how many it moved, 0 meaning EOF.
+
+    splice: move the data in the kernel, never copying it to userspace
+    readinto: read into one preallocated buffer and write it out from there
+    read: allocate a new bytes object for every read '''
+    if method == 'splice':
+        return lambda n: os.splice(fd_in, fd_out, n)
+    if method == 'readinto':
+        view = memoryview(bytearray(buffer_size))
+
+        def forward(n):
+            got = os.readv(fd_in, [view[:n]])
+            write_all(fd_out, view[:got])
+            return got
+        return forward
+    if method == 'read':
+        def forward(n):
+            data = os.read(fd_in, n)
+            write_all(fd_out, data)
+            return len(data)
+        return forward
+    raise ValueError('Unknown method %s' % (method,))
+
+
+class TokenBucket:
+    ''' Lets through rate bytes a second on average, in bursts of up to burst
+    bytes '''
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def take(self, n):
+        ''' Wait until some bytes may be sent, and return how many, at most
+        n. Call spend() with how many actually were. '''
+        want = min(n, self.burst)
+        self._refill()
+        if self.tokens < want:
+            time.sleep((want - self.tokens) / self.rate)
+            self._refill()
+        return max(1, min(n, int(self.tokens)))
+
+    def spend(self, n):
+        self.tokens -= n
+
+
+def consume(read, stats):
+    ''' Call read() until EOF, adding each read to stats '''
+    add = stats.add
+    n = read()
+    while n:
+        add(n)
+        n = read()
+
+
+class Source:
+    ''' Something to drain: a stream, or a listening socket that streams are
+    accepted from. Streams have a Stats and a read function that reads into
+    a list of buffers and returns how many bytes it read, 0 meaning EOF. '''
+    def __init__(self, name, fileobj, read=None, stats=None, accept=0):
+        self.name = name
+        self.fileobj = fileobj
+        self.read = read
+        self.stats = stats
+        # for listeners, how many more streams to accept (None for no limit)
+        # and how many have been
+        self.accept = accept
+        self.accepted = 0
+
+    def fileno(self):
+        return self.fileobj if isinstance(self.fileobj, int) \
+            else self.fileobj.fileno()
+
+    def close(self):
+        if isinstance(self.fileobj, int):
+            os.close(self.fileobj)
+        else:
+            self.fileobj.close()
+
+
+def listen(spec, accept):
+    ''' Return a listening Source for tcp:[HOST:]PORT or unix:PATH '''
+    kind, _, where = spec.partition(':')
+    if kind == 'tcp':
+        host, _, port = where.rpartition(':')
+        host = host.strip('[]')
+        family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, int(port)))
+    else:
+        if os.path.exists(where) and \
+                stat.S_ISSOCK(os.stat(where).st_mode):
+            os.unlink(where)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(where)
+    sock.listen(1024)
+    sock.setblocking(False)
+    return Source(spec, sock, accept=accept or None)
+
+
+def open_source(spec, args):
+    ''' Return a Source for the given spec, which is one of
+        tcp:[HOST:]PORT  listen on a TCP port and drain every connection
+        unix:PATH        listen on a Unix socket and drain every connection
+        fifo:PATH        drain a FIFO, creating it if needed, until its
+                         writers close it
+        file:PATH        drain a file (or device) until EOF
+        -                drain stdin until EOF '''
+    kind, _, where = spec.partition(':')
+    if kind in ('tcp', 'unix'):
+        return listen(spec, args.accept)
+    if spec == '-':
+        fd = os.dup(sys.stdin.fileno())
+    elif kind == 'fifo':
+        if not os.path.exists(where):
+            os.mkfifo(where)
+        # non-blocking so opening doesn't wait for a writer
+        fd = os.open(where, os.O_RDONLY | os.O_NONBLOCK)
+    elif kind == 'file':
+        fd = os.open(where, os.O_RDONLY | os.O_NONBLOCK)
+    else:
+        raise ValueError('Unknown source %s' % (spec,))
+    return Source(spec, fd, lambda bufs: os.readv(fd, bufs),
+                  Stats(spec, args.interval, args.stall))
+
+
+def consume_limited(forward, stats, bucket, buffer_size):
+    ''' Like consume(), but only forwarding as fast as bucket allows '''
+    n = forward(bucket.take(buffer_size))
+    while n:
+        bucket.spend(n)
+        stats.add(n)
+        n = forward(bucket.take(buffer_size))
+
+
+def main_passthrough(args):
+    ''' Copy stdin to stdout until EOF, measuring it like main() does '''
+    fd_in, fd_out = sys.stdin.fileno(), sys.stdout.fileno()
+    method = args.method
+    if method == 'auto':
+        method = 'splice' if can_splice(fd_in, fd_out) else 'readinto'
+    forward = make_forwarder(fd_in, fd_out, method, args.buffer_size)
+    # Don't record the start time until we've read the first byte
+    first = os.read(fd_in, 1)
+    if not first:
+        print('OVERALL: 0 bytes', file=sys.stderr)
+        return
+    write_all(fd_out, first)
+    stats = Stats('stdin', args.interval, args.stall)
+    stats.start(1)
+    sampler = Sampler(args.interval, None if args.quiet else print_samples)
+    sampler.add(stats)
+    sampler.start()
+    try:
+        if args.rate_limit:
+            bucket = TokenBucket(args.rate_limit * 1000 * 1000 / 8,
+                                 args.burst or args.buffer_size)
+            consume_limited(forward, stats, bucket, args.buffer_size)
+        else:
+            buffer_size = args.buffer_size
+            consume(lambda: forward(buffer_size), stats)
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+    finally:
+        stats.finish()
+        sampler.stop()
+    print_summary(stats)
+    write_outputs(stats, args)
+
+
+def main_multi(args):
+    ''' Drain all the sources at once from one selectors loop, reporting
+    each one's throughput and their total '''
+    sel = selectors.DefaultSelector()
+    # sources that can't be waited on, like regular files, are always ready
+    always_ready = []
+    total = Stats('total', args.interval, args.stall)
+    sampler = Sampler(
+        args.interval, None if args.quiet else print_multi_samples)
+    sampler.add(total)
+    streams = []
+    bufs = [bytearray(args.buffer_size)]
+
+    def add_stream(source):
+        sampler.add(source.stats)
+        streams.append(source.stats)
+        try:
+            sel.register(source.fileobj, selectors.EVENT_READ, source)
+        except PermissionError:
+            always_ready.append(source)
+
+    def remove(source):
+        if source in always_ready:
+            always_ready.remove(source)
+        else:
+            sel.unregister(source.fileobj)
+        source.close()
+        if source.stats:
+            source.stats.finish()
+
+    def accept(source):
+        try:
+            conn, addr = source.fileobj.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        source.accepted += 1
+        if isinstance(addr, tuple):
+            name = 'tcp:%s:%d' % addr[:2]
+        else:
+            # the other ends of Unix sockets usually don't have names
+            name = '%s#%d' % (source.name, source.accepted)
+        add_stream(Source(name, conn, lambda bufs: conn.recv_into(bufs[0]),
+                          Stats(name, args.interval, args.stall)))
+        if source.accept is not None:
+            source.accept -= 1
+            if not source.accept:
+                remove(source)
+
+    def drain(source):
+        try:
+            n = source.read(bufs)
+        except BlockingIOError:
+            return
+        except ConnectionError:
+            n = 0
+        if n:
+            # each clock starts at its stream's first byte, like main()'s
+            for stats in (source.stats, total):
+                if stats.start_time is None:
+                    stats.start(n)
+                else:
+                    stats.add(n)
+        else:
+            remove(source)
+
+    for spec in args.source:
+        source = open_source(spec, args)
+        if source.stats:
+            add_stream(source)
+        else:
+            sel.register(source.fileobj, selectors.EVENT_READ, source)
+    sampler.start()
+    try:
+        while sel.get_map() or always_ready:
+            for key, _ in sel.select(0 if always_ready else None):
+                if key.data.stats:
+                    drain(key.data)
+                else:
+                    accept(key.data)
+            for source in list(always_ready):
+                drain(source)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for key in list(sel.get_map().values()):
+            remove(key.data)
+        total.finish()
+        sampler.stop()
+    if total.start_time is None:
+        print('OVERALL: 0 bytes', file=sys.stderr)
+        return
+    print_summary(total, streams)
+    write_outputs(total, args, streams)
+
+
+def fill_pipe(seconds, buffer_size):
+    ''' Fork a child that writes to a new pipe as fast as it can for the
+    given number of seconds. Returns the read end and the child's pid. '''
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        buf = bytes(buffer_size)
+        end = time.monotonic() + seconds
+        try:
+            while time.monotonic() < end:
+                os.write(w, buf)
+        finally:
+            os._exit(0)
+    os.close(w)
+    return r, pid
+
+
+def time_drain(read):
+    ''' Call read() until EOF and return the bytes and seconds it took '''
+    count = 0
+    start = time.monotonic()
+    n = read()
+    while n:
+        count += n
+        n = read()
+    return count, time.monotonic() - start
+
+
+def print_rate(name, count, duration):
+    print('%-20s %0.2f Gbps (%d bytes in %0.2f seconds)' % (
+        name, count * 8 / duration / 1000 / 1000 / 1000, count, duration))
+
+
+def benchmark(args):
+    ''' Feed a pipe from a child process as fast as possible and time how fast
+    each method drains it. Then put cat, and each --passthrough method, in
+    the middle of that pipe and time how fast it all goes. The other
+    processes cost CPU too, so these are lower bounds on what the tool can
+    do. '''
+    methods = [m for m in METHODS[1:]
+               if m != 'splice' or hasattr(os, 'splice')]
+    for method in methods:
+        r, pid = fill_pipe(args.benchmark_seconds, args.buffer_size)
+        count, duration = time_drain(
+            make_reader(r, method, args.buffer_size))
+        os.waitpid(pid, 0)
+        os.close(r)
+        print_rate(method, count, duration)
+    drain_method = 'splice' if 'splice' in methods else 'readinto'
+    for method in ['cat'] + methods:
+        r, writer = fill_pipe(args.benchmark_seconds, args.buffer_size)
+        r2, w2 = os.pipe()
+        if method == 'cat':
+            middle = subprocess.Popen(['cat'], stdin=r, stdout=w2)
+        else:
+            middle = os.fork()
+            if middle == 0:
+                os.close(r2)
+                forward = make_forwarder(r, w2, method, args.buffer_size)
+                try:
+                    while forward(args.buffer_size):
+                        pass
+                finally:
+                    os._exit(0)
+        os.close(r)
+        os.close(w2)
+        count, duration = time_drain(
+            make_reader(r2, drain_method, args.buffer_size))
+        os.waitpid(writer, 0)
+        if method == 'cat':
+            middle.wait()
+        else:
+            os.waitpid(middle, 0)
+        os.close(r2)
+        print_rate('cat' if method == 'cat' else 'passthrough ' + method,
+                   count, duration)
+
+
+def main(args):
+    fd = sys.stdin.fileno()
+    read = make_reader(
+        fd, choose_method(fd, args.method), args.buffer_size)
+    # Don't record the start time until we've read the first byte
+    if not make_reader(fd, 'read', 1)():
+        print('OVERALL: 0 bytes', file=sys.stderr)
+        return
+    stats = Stats('stdin', args.interval, args.stall)
+    stats.start(1)
+    sampler = Sampler(args.interval, None if args.quiet else print_samples)
+    sampler.add(stats)
+    sampler.start()
+    # Keep reading until no more data
+    try:
+        consume(read, stats)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stats.finish()
+        sampler.stop()
+    print_summary(stats)
+    write_outputs(stats, args)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        description='Read stdin until EOF and report how fast it was read')
+    parser.add_argument(
+        '-m', '--method', choices=METHODS, default='auto',
+        help='How to read. auto uses splice if stdin is a pipe (with '
+        '--passthrough, if stdin or stdout is), else readinto')
+    parser.add_argument(
+        '-b', '--buffer-size', type=int, default=256 * 1024,
+        help='Most bytes to read at once')
+    parser.add_argument(
+        '-s', '--source', action='append', metavar='SOURCE',
+        help='Instead of stdin, drain this source. Can be given many times, '
+        'and all sources are drained at once. A source is tcp:[HOST:]PORT or '
+        'unix:PATH to listen and drain every connection, fifo:PATH, '
+        'file:PATH, or - for stdin')
+    parser.add_argument(
+        '--accept', type=int, default=0,
+        help='Stop listening on each tcp: or unix: source after this many '
+        'connections, so the program ends once they are done. 0 means keep '
+        'listening until interrupted')
+    parser.add_argument(
+        '-p', '--passthrough', action='store_true',
+        help='Copy stdin to stdout while measuring it, like pv')
+    parser.add_argument(
+        '--rate-limit', type=float, metavar='MBPS',
+        help='With --passthrough, copy no faster than this many Mbps')
+    parser.add_argument(
+        '--burst', type=int, metavar='BYTES',
+        help='With --rate-limit, the most bytes to copy at once. Default is '
+        'the buffer size')
+    parser.add_argument(
+        '-i', '--interval', type=float, default=1.0,
+        help='Seconds between throughput samples')
+    parser.add_argument(
+        '--stall', type=float, default=1.0,
+        help='Count a wait of at least this many seconds between two reads '
+        'as a stall')
+    parser.add_argument(
+        '-q', '--quiet', action='store_true',
+        help='Don\'t print each sample as it\'s taken, only the summary')
+    parser.add_argument(
+        '--json', metavar='FILE',
+        help='Write all the statistics, including every sample, as JSON to '
+        'this file (- for stdout)')
+    parser.add_argument(
+        '--csv', metavar='FILE',
+        help='Write "seconds,Mbps" for every sample to this file (- for '
+        'stdout). plot-xy.py can plot it')
+    parser.add_argument(
+        '--rates', metavar='FILE',
+        help='Write the Mbps of every sample, one per line, to this file (- '
+        'for stdout). plot-cdf.py can plot it')
+    parser.add_argument(
+        '--benchmark', action='store_true',
+        help='Instead of reading stdin, measure how fast each method can '
+        'read from a pipe on this machine')
+    parser.add_argument(
+        '--benchmark-seconds', type=float, default=2,
+        help='How long to run each method for with --benchmark')
+    args = parser.parse_args()
+    try:
+        if args.benchmark:
+            benchmark(args)
+        elif args.passthrough:
+            if '-' in (args.json, args.csv, args.rates):
+                parser.error('stdout is for the data with --passthrough')
+            if args.method == 'splice' and not can_splice(
+                    sys.stdin.fileno(), sys.stdout.fileno()):
+                parser.error('-m splice with --passthrough needs stdin or '
+                             'stdout to be a pipe, and stdout not to be a '
+                             'terminal or opened for appending')
+            main_passthrough(args)
+        elif args.source:
+            main_multi(args)
+        else:
+            if args.method == 'splice' and not (
+                    hasattr(os, 'splice') and is_pipe(sys.stdin.fileno())):
+                parser.error('-m splice needs stdin to be a pipe')
+            main(args)
+    except KeyboardInterrupt:
+        print()